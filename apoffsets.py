@@ -1,16 +1,125 @@
 """Get offsets from fractional row/column/aperture"""
 
 import math
+import collections
 import numpy as np
 
-def ap_offsets(col, row, apsize):
-    """Get integer offsets in array for circle delineated by apsize at row/col.
-    row, col and apsize may all be fractional"""
+DEFAULT_STEP = 0.01
+DEFAULT_MAXCACHE = 8192
+
+quant_step = DEFAULT_STEP
+max_cache = DEFAULT_MAXCACHE
+offset_cache = collections.OrderedDict()
+cache_stats = dict(hits=0, misses=0)
+
+
+class ApOffsetsErr(Exception):
+    """Throw if aperture goes off the edge of the array, edge is left, right, bottom or top"""
+
+    def __init__(self, edge):
+        super().__init__("Aperture too close to " + edge + " edge")
+        self.edge = edge
+
+
+def set_cache(step=None, maxsize=None):
+    """Set the step fractional row/column are quantized to and/or maximum number of
+    cached offset templates, clearing the cache. Step of 0 means no quantizing"""
+    global quant_step, max_cache
+    if step is not None:
+        quant_step = step
+    if maxsize is not None:
+        max_cache = maxsize
+    offset_cache.clear()
+
+
+def get_cache_stats():
+    """Get dictionary of cache hits and misses and number of templates cached"""
+    result = cache_stats.copy()
+    result['size'] = len(offset_cache)
+    return  result
+
+
+def quantize(frac):
+    """Quantize fractional part of row or column to current step"""
+    if quant_step <= 0:
+        return  frac
+    return  round(frac / quant_step) * quant_step
+
+
+def cached_template(key, makefn):
+    """Look up template in the cache making it with makefn if not there, discarding
+    the least recently used if the cache is full"""
+    try:
+        result = offset_cache[key]
+        offset_cache.move_to_end(key)
+        cache_stats['hits'] += 1
+        return  result
+    except KeyError:
+        pass
+    cache_stats['misses'] += 1
+    result = makefn()
+    result.flags.writeable = False
+    offset_cache[key] = result
+    while len(offset_cache) > max_cache:
+        offset_cache.popitem(last=False)
+    return  result
+
 
-    apsq = apsize **2
+def make_offsets(colfrac, rowfrac, apsize):
+    """Make the array of (x, y) offsets for the circle"""
     iapsize = int(math.ceil(apsize))
-    rng = range(-iapsize, iapsize+2)
+    rng = np.arange(-iapsize, iapsize+2)
     xpoints, ypoints = np.meshgrid(rng, rng)
-    colfrac, dummy = math.modf(col)
-    rowfrac, dummy = math.modf(row)
-    return np.array([(x,y) for x,y in zip(xpoints.flatten(), ypoints.flatten()) if (x - colfrac) ** 2 + (y - rowfrac) ** 2 <= apsq])
+    mask = (xpoints - colfrac) ** 2 + (ypoints - rowfrac) ** 2 <= apsize ** 2
+    return  np.column_stack((xpoints[mask], ypoints[mask]))
+
+
+def ap_offsets(col, row, apsize):
+    """Get integer offsets in array for circle delineated by apsize at row/col.
+    row, col and apsize may all be fractional.
+    The result is cached and read-only"""
+
+    colfrac = quantize(math.modf(col)[0])
+    rowfrac = quantize(math.modf(row)[0])
+    return  cached_template((apsize, colfrac, rowfrac), lambda: make_offsets(colfrac, rowfrac, apsize))
+
+
+def ap_linear_offsets(col, row, apsize, width):
+    """Get offsets in flattened array of given width for circle as ap_offsets.
+    The result is cached and read-only"""
+
+    colfrac = quantize(math.modf(col)[0])
+    rowfrac = quantize(math.modf(row)[0])
+    return  cached_template((apsize, colfrac, rowfrac, width), lambda: np.dot(make_offsets(colfrac, rowfrac, apsize), (1, width)))
+
+
+def ap_indices(col, row, apsize, width):
+    """Get indices in flattened array of given width of the pixels in circle of apsize
+    at row/col so they can be gathered with one take.
+    NB no check is made that the circle is inside the array"""
+
+    return  ap_linear_offsets(col, row, apsize, width) + (int(row) * width + int(col))
+
+
+def ap_gather(col, row, apsize, arrays, limits=None):
+    """Get offsets from ap_offsets and the pixel values in the aperture of each of arrays
+    with one indexing operation per array.
+    limits is (mincol, maxcol, minrow, maxrow) with the maximums 1 more than allowed,
+    defaulting to the shape of the first array. Raise ApOffsetsErr if outside"""
+
+    xyoffsets = ap_offsets(col, row, apsize)
+    xpixes = xyoffsets[:,0] + int(col)
+    ypixes = xyoffsets[:,1] + int(row)
+    if limits is None:
+        pixrows, pixcols = arrays[0].shape
+        limits = (0, pixcols, 0, pixrows)
+    mincol, maxcol, minrow, maxrow = limits
+    if xpixes.min() < mincol:
+        raise ApOffsetsErr("left")
+    if xpixes.max() >= maxcol:
+        raise ApOffsetsErr("right")
+    if ypixes.min() < minrow:
+        raise ApOffsetsErr("bottom")
+    if ypixes.max() >= maxrow:
+        raise ApOffsetsErr("top")
+    return  (xyoffsets, [a[ypixes, xpixes] for a in arrays])
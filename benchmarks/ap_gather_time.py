@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+
+"""Compare per-object time gathering aperture pixels with the old per-pixel list comprehensions
+and apoffsets.ap_gather as used in find_object, opt_aperture_list and StdArray.get_sum"""
+
+import argparse
+import math
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import apoffsets        # pylint: disable=wrong-import-position
+
+
+def old_find_object(imagedata, col, row, apsize, limits):
+    """Gather as find_object did"""
+    mincol, maxcol, minrow, maxrow = limits
+    xypixoffsets = apoffsets.ap_offsets(col, row, apsize)
+    xypixes = xypixoffsets + (int(col), int(row))
+    xpixes = xypixes[:,0]
+    ypixes = xypixes[:,1]
+    if xpixes.min() < mincol or xpixes.max() >= maxcol or ypixes.min() < minrow or ypixes.max() >= maxrow:
+        raise ValueError("Edge")
+    return  (xypixoffsets, np.array([imagedata[y, x] for x, y in xypixes]))
+
+
+def new_find_object(imagedata, col, row, apsize, limits):
+    """Gather as find_object does now"""
+    xypixoffsets, (datavals, ) = apoffsets.ap_gather(col, row, apsize, (imagedata, ), limits)
+    return  (xypixoffsets, datavals)
+
+
+def old_opt_aperture_list(imagedata, col, row, apsizes):
+    """Gather for each aperture as opt_aperture_list did"""
+    for possap in apsizes:
+        xycoords = apoffsets.ap_offsets(col, row, possap)
+        np.array([imagedata[y,x] for x,y in xycoords+(int(col),int(row))])
+
+
+def new_opt_aperture_list(imagedata, col, row, apsizes):
+    """Gather for each aperture as opt_aperture_list does now"""
+    for possap in apsizes:
+        apoffsets.ap_gather(col, row, possap, (imagedata, ))
+
+
+def old_get_sum(vs, errs, col, row, apsize):
+    """Sum as StdArray.get_sum did"""
+    xycoords = apoffsets.ap_offsets(col, row, apsize) + (int(col), int(row))
+    return  (np.sum([vs[(y,x)] for x,y in xycoords]), math.sqrt(np.sum([errs[(y,x)] for x, y in xycoords])))
+
+
+def new_get_sum(vs, errs, col, row, apsize):
+    """Sum as StdArray.get_sum does now"""
+    dummy, (gvs, gerrs) = apoffsets.ap_gather(col, row, apsize, (vs, errs))
+    return  (np.sum(gvs), math.sqrt(np.sum(gerrs)))
+
+
+def main():
+    """Run benchmark"""
+    parsearg = argparse.ArgumentParser(description='Compare per-object aperture gather time', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parsearg.add_argument('--size', type=int, default=1024, help='Rows and columns in test image')
+    parsearg.add_argument('--objects', type=int, default=200, help='Number of objects')
+    parsearg.add_argument('--apsize', type=float, default=6.0, help='Aperture size')
+    parsearg.add_argument('--minap', type=float, default=3.0, help='Minimum aperture for opt_aperture_list')
+    parsearg.add_argument('--maxap', type=float, default=20.0, help='Maximum aperture for opt_aperture_list')
+    parsearg.add_argument('--repeat', type=int, default=5, help='Number of times to time each')
+    resargs = vars(parsearg.parse_args())
+
+    size = resargs['size']
+    apsize = resargs['apsize']
+    maxap = resargs['maxap']
+    nobjs = resargs['objects']
+    rng = np.random.default_rng(0)
+    imagedata = rng.normal(100, 5, (size, size))
+    errs = rng.uniform(1, 2, (size, size))
+    places = rng.uniform(maxap + 2, size - maxap - 2, (nobjs, 2))
+    iap = int(math.floor(apsize))
+    limits = (iap + 1, size - iap, iap + 1, size - iap)
+    apsizes = np.arange(resargs['minap'], maxap + 1.0, 1.0)
+
+    # Check they agree before timing
+
+    for col, row in places:
+        assert np.array_equal(old_find_object(imagedata, col, row, apsize, limits)[1], new_find_object(imagedata, col, row, apsize, limits)[1])
+        assert np.allclose(old_get_sum(imagedata, errs, col, row, apsize), new_get_sum(imagedata, errs, col, row, apsize))
+
+    tests = (("find_object", lambda col, row: old_find_object(imagedata, col, row, apsize, limits), lambda col, row: new_find_object(imagedata, col, row, apsize, limits)),
+             ("opt_aperture_list", lambda col, row: old_opt_aperture_list(imagedata, col, row, apsizes), lambda col, row: new_opt_aperture_list(imagedata, col, row, apsizes)),
+             ("StdArray.get_sum", lambda col, row: old_get_sum(imagedata, errs, col, row, apsize), lambda col, row: new_get_sum(imagedata, errs, col, row, apsize)))
+
+    print("{:d} objects aperture {:.1f} in {:d}x{:d} image, microseconds per object".format(nobjs, apsize, size, size))
+    for name, oldfn, newfn in tests:
+        times = []
+        for fn in (oldfn, newfn):
+            t = min(timeit.repeat(lambda: [fn(col, row) for col, row in places], number=1, repeat=resargs['repeat']))
+            times.append(t * 1e6 / nobjs)
+        print("{:20s} old {:10.1f} new {:10.1f} speedup {:6.1f}".format(name, times[0], times[1], times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+
+"""Compare peak memory opening gzipped in-memory FITS file with the old gzip.decompress
+path and fitsops.mem_open which decompresses as it goes"""
+
+import argparse
+import gzip
+import io
+import os
+import sys
+import tracemalloc
+import numpy as np
+from astropy.io import fits
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitsops          # pylint: disable=wrong-import-position
+
+
+def old_mem_open(bytestring):
+    """mem_open as it was, making a decompressed copy first"""
+    try:
+        stream = gzip.decompress(bytestring)
+    except OSError:
+        return None
+    try:
+        return fits.open(io.BytesIO(stream), memmap=False, lazy_load_hdus=False)
+    except OSError:
+        return None
+
+
+def peak_of(openfn, bytestring):
+    """Get peak traced memory in bytes opening file and getting data"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    ff = openfn(bytestring)
+    data = ff[0].data
+    ff.close()
+    dummy, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return  peak
+
+
+def main():
+    """Run benchmark"""
+    parsearg = argparse.ArgumentParser(description='Compare peak memory of old and new mem_open', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parsearg.add_argument('--size', type=int, default=1024, help='Rows and columns in test image')
+    parsearg.add_argument('--repeat', type=int, default=3, help='Number of times to measure each')
+    resargs = vars(parsearg.parse_args())
+
+    size = resargs['size']
+    rng = np.random.default_rng(0)
+    data = (rng.normal(1000, 30, (size, size))).astype(np.int16)
+    bytestring = fitsops.mem_makefits(fits.Header(), data)
+    print("Test image {:d}x{:d} int16, {:.2f} MB gzipped".format(size, size, len(bytestring) / 1e6))
+
+    for name, openfn in (("old gzip.decompress", old_mem_open), ("new GzipFile", fitsops.mem_open)):
+        peaks = [peak_of(openfn, bytestring) for dummy in range(resargs['repeat'])]
+        print("{:20s} peak {:8.2f} MB".format(name, min(peaks) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
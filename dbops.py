@@ -10,12 +10,111 @@
 # Get DB credentials from standard places
 
 import os
+import re
 import sys
 import time
+import json
+import datetime
+import fcntl
+import socket
+import tempfile
+import subprocess
+import threading
+import contextlib
 import pymysql
 import dbcredentials
 
 MAXTRIES = 10
+DEFAULT_POOLSIZE = 4
+TUNNEL_TIMEOUT = 20.0
+DEFAULT_BLOCKSIZE = 512
+DEFAULT_SLOWTHRESHOLD = 1.0
+MAXSHAPES = 1000
+
+# Statistics of statements executed by DBops_cursor, indexed by normalised SQL
+
+stats_lock = threading.Lock()
+stmt_stats = dict()
+retry_stats = dict(retries=0, backofftime=0.0, failures=0)
+slowlog_name = None
+slowlog_threshold = DEFAULT_SLOWTHRESHOLD
+
+norm_patterns = ((re.compile(r"'(?:[^'\\]|\\.)*'"), '?'),
+                 (re.compile(r'"(?:[^"\\]|\\.)*"'), '?'),
+                 (re.compile(r'(?<![\w.])-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b'), '?'),
+                 (re.compile(r'%s'), '?'),
+                 (re.compile(r'\s+'), ' '),
+                 (re.compile(r'\(\s?\?(?:\s?,\s?\?)*\s?\)'), '(?)'),
+                 (re.compile(r'\(\?\)(?:\s?,\s?\(\?\))+'), '(?),...'),
+                 (re.compile(r'\bWHEN \? THEN \?(?: WHEN \? THEN \?)+', re.IGNORECASE), 'WHEN ? THEN ?'))
+
+
+def normalise_sql(sql):
+    """Reduce SQL statement to its shape with literal values taken out"""
+    for pat, repl in norm_patterns:
+        sql = pat.sub(repl, sql)
+    return  sql.strip()
+
+
+def record_stmt(sql, elapsed, rows, retries, backoff):
+    """Add statement to statistics and log if slow.
+    elapsed is the time of the successful attempt only, backoff the time slept before it"""
+    shape = normalise_sql(sql)
+    with stats_lock:
+        try:
+            st = stmt_stats[shape]
+        except KeyError:
+            if len(stmt_stats) >= MAXSHAPES:
+                shape = "(other)"
+            st = stmt_stats.setdefault(shape, dict(count=0, total=0.0, max=0.0, rows=0, retries=0, backoff=0.0))
+        st['count'] += 1
+        st['total'] += elapsed
+        st['max'] = max(st['max'], elapsed)
+        st['rows'] += rows
+        st['retries'] += retries
+        st['backoff'] += backoff
+    if slowlog_name is not None and elapsed >= slowlog_threshold:
+        write_slowlog(sql, elapsed, rows)
+
+
+def write_slowlog(sql, elapsed, rows):
+    """Write entry for slow query to log file"""
+    try:
+        with open(slowlog_name, "a") as outf:
+            fcntl.lockf(outf, fcntl.LOCK_EX)
+            print("{:%Y-%m-%d %H:%M:%S} pid={:d} {:.3f}s rows={:d} {:s}".format(datetime.datetime.now(), os.getpid(), elapsed, rows, " ".join(sql.split())[:2000]), file=outf)
+            fcntl.lockf(outf, fcntl.LOCK_UN)
+    except OSError:
+        pass
+
+
+def set_slowlog(fname, threshold=DEFAULT_SLOWTHRESHOLD):
+    """Turn on logging of statements taking at least threshold seconds to file (None to turn off)"""
+    global slowlog_name, slowlog_threshold
+    slowlog_name = fname
+    slowlog_threshold = threshold
+
+
+def stats():
+    """Return snapshot of statement statistics"""
+    with stats_lock:
+        return  dict(statements={shape: dict(st) for shape, st in stmt_stats.items()}, **retry_stats)
+
+
+def reset_stats():
+    """Reset statement statistics"""
+    with stats_lock:
+        stmt_stats.clear()
+        retry_stats.update(retries=0, backofftime=0.0, failures=0)
+
+
+def dump_stats(outfile=sys.stderr):
+    """Dump statistics as JSON to given file with statements sorted by total time"""
+    snap = stats()
+    snap['statements'] = dict(sorted(snap['statements'].items(), key=lambda x: x[1]['total'], reverse=True))
+    json.dump(snap, outfile, indent=2)
+    print(file=outfile)
+
 
 class dbopsError(Exception):
     """Exception in case of error"""
@@ -28,20 +127,40 @@ class DBops_cursor:
         self.connection = curs.connection
         self.lastrowid = 0
 
-    def execute(self, *args):
-        """Check execution of args"""
+    def run(self, method, args):
+        """Run execute or executemany checking for lock hold off and recording stats"""
         tries = 1
+        backoff = 0.0
         while tries <= MAXTRIES:
+            started = time.perf_counter()
             try:
-                ret =  self.cursor.execute(*args)
+                ret =  method(*args)
+                elapsed = time.perf_counter() - started
                 self.lastrowid = self.cursor.lastrowid
+                record_stmt(args[0], elapsed, self.cursor.rowcount, tries - 1, backoff)
                 return  ret
             except pymysql.OperationalError:
                 print("Backing off for {:d} seconds".format(tries), file=sys.stderr)
+                sleepstart = time.perf_counter()
                 time.sleep(tries)
+                slept = time.perf_counter() - sleepstart
+                backoff += slept
+                with stats_lock:
+                    retry_stats['retries'] += 1
+                    retry_stats['backofftime'] += slept
             tries += 1
+        with stats_lock:
+            retry_stats['failures'] += 1
         raise dbopsError("Exceeded number of tries")
 
+    def execute(self, *args):
+        """Check execution of args"""
+        return  self.run(self.cursor.execute, args)
+
+    def executemany(self, *args):
+        """Check execution of statement with many sets of args"""
+        return  self.run(self.cursor.executemany, args)
+
     def fetchall(self):
         """Duplicate fetchall"""
         return  self.cursor.fetchall()
@@ -50,6 +169,50 @@ class DBops_cursor:
         """Duplicate fetchone"""
         return  self.cursor.fetchone()
 
+    def close(self):
+        """Duplicate close"""
+        self.cursor.close()
+
+def insert_many(dbcurs, table, columns, rows, update=None, blocksize=DEFAULT_BLOCKSIZE):
+    """Insert rows (each a sequence of values corresponding to columns) into table
+    using multi-row INSERT statements with the values passed as parameters.
+    If update is given as a list of columns, update those on duplicate key.
+    Return total of rows affected"""
+    rows = list(rows)
+    if len(rows) == 0:
+        return  0
+    sql = "INSERT INTO " + table + " (" + ",".join(columns) + ") VALUES "
+    rowph = "(" + ",".join(["%s"] * len(columns)) + ")"
+    tail = ""
+    if update:
+        tail = " ON DUPLICATE KEY UPDATE " + ",".join(["{0:s}=VALUES({0:s})".format(c) for c in update])
+    n = 0
+    for start in range(0, len(rows), blocksize):
+        block = rows[start:start+blocksize]
+        n += dbcurs.execute(sql + ",".join([rowph] * len(block)) + tail, [v for row in block for v in row])
+    return  n
+
+
+def update_many(dbcurs, table, keycol, columns, rows, blocksize=DEFAULT_BLOCKSIZE):
+    """Update columns in several rows of table in one statement using CASE on keycol.
+    Each row is key value followed by values corresponding to columns.
+    Return total of rows affected"""
+    rows = list(rows)
+    n = 0
+    for start in range(0, len(rows), blocksize):
+        block = rows[start:start+blocksize]
+        sets = []
+        args = []
+        for cn, col in enumerate(columns, 1):
+            sets.append(col + "=CASE " + keycol + " " + " ".join(["WHEN %s THEN %s"] * len(block)) + " END")
+            for row in block:
+                args.append(row[0])
+                args.append(row[cn])
+        args += [row[0] for row in block]
+        n += dbcurs.execute("UPDATE " + table + " SET " + ",".join(sets) + " WHERE " + keycol + " IN (" + ",".join(["%s"] * len(block)) + ")", args)
+    return  n
+
+
 def opendb(name):
     """Open the database with the name given"""
 
@@ -73,12 +236,178 @@ def opendb(name):
         if e.args[0] != 2003:
             raise dbopsError("Could  not connect to database error was " + e.args[1])
 
-    if os.fork() == 0:
-        os.execvp("ssh", ["ssh", "-nNT", "-L", "%d:localhost:%d" % (int(creds.localport), int(creds.remoteport)), "%s@%s" % (creds.login, creds.host)])
-        sys.exit(255)
-
-    time.sleep(5)
+    start_tunnel(creds)
     try:
         return  pymysql.connect(host='localhost', port=int(creds.localport), user=creds.user, passwd=creds.password, db=creds.database)
     except pymysql.OperationalError as e:
         raise dbopsError("Could  not connect to database after SSH tunnel error was " + e.args[1])
+
+
+def tunnel_paths(creds):
+    """Get names of lock file and SSH control socket for tunnel"""
+    base = os.path.join(tempfile.gettempdir(), "dbops-{:d}-{:d}".format(os.getuid(), int(creds.localport)))
+    return  (base + ".lock", base + ".ctl")
+
+
+def wait_port(port, timeout):
+    """Poll local port with increasing delay until something listens on it or we time out.
+    Return whether it came up"""
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while True:
+        try:
+            socket.create_connection(('localhost', port), timeout=1.0).close()
+            return  True
+        except OSError:
+            pass
+        if time.monotonic() >= deadline:
+            return  False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def start_tunnel(creds):
+    """Start SSH tunnel unless another process has done so. We lock out other processes
+    whilst doing this so only one tunnel gets started, which is run as control master
+    on a known socket so other processes can find it"""
+
+    localport = int(creds.localport)
+    forward = "%d:localhost:%d" % (localport, int(creds.remoteport))
+    remote = "%s@%s" % (creds.login, creds.host)
+    lockname, ctlname = tunnel_paths(creds)
+
+    try:
+        with open(lockname, 'a') as lockf:
+            fcntl.lockf(lockf, fcntl.LOCK_EX)
+
+            # Someone else may have set it up whilst we were waiting for the lock
+
+            if wait_port(localport, 0):
+                return
+
+            if subprocess.call(["ssh", "-S", ctlname, "-O", "check", remote], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+                subprocess.call(["ssh", "-S", ctlname, "-O", "forward", "-L", forward, remote], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                try:
+                    os.unlink(ctlname)
+                except OSError:
+                    pass
+                subprocess.call(["ssh", "-fnNT", "-M", "-S", ctlname, "-o", "ExitOnForwardFailure=yes", "-L", forward, remote])
+
+            if not wait_port(localport, TUNNEL_TIMEOUT):
+                raise dbopsError("SSH tunnel to " + remote + " did not start")
+    except OSError as e:
+        raise dbopsError("Could not start SSH tunnel error was " + str(e))
+
+
+class ConnectionPool:
+    """Fixed size pool of connections to the database with the name given.
+    Each thread checks out its own connection, a thread checking out again whilst it
+    holds one gets the same one back"""
+
+    def __init__(self, name, size=DEFAULT_POOLSIZE, timeout=None):
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.created = 0
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.waittime = self.maxwait = 0.0
+        self.checkouts = self.active = self.reconnects = 0
+
+    def check_alive(self, conn):
+        """Check connection still works, reconnecting if not"""
+        try:
+            conn.ping(reconnect=False)
+            return  conn
+        except pymysql.Error:
+            pass
+        with self.cond:
+            self.reconnects += 1
+        try:
+            conn.ping(reconnect=True)
+            return  conn
+        except pymysql.Error:
+            conn.close()
+        return  opendb(self.name)
+
+    def checkout(self):
+        """Get connection for current thread waiting if necessary for one to become free"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.depth += 1
+            return  conn
+        started = time.perf_counter()
+        with self.cond:
+            while len(self.idle) == 0 and self.created >= self.size:
+                if not self.cond.wait(self.timeout):
+                    raise dbopsError("Timed out waiting for database connection")
+            if len(self.idle) != 0:
+                conn = self.idle.pop()
+            else:
+                self.created += 1
+            waited = time.perf_counter() - started
+            self.waittime += waited
+            self.maxwait = max(self.maxwait, waited)
+            self.checkouts += 1
+            self.active += 1
+        try:
+            if conn is None:
+                conn = opendb(self.name)
+            else:
+                conn = self.check_alive(conn)
+        except dbopsError:
+            with self.cond:
+                self.created -= 1
+                self.active -= 1
+                self.cond.notify()
+            raise
+        self.local.conn = conn
+        self.local.depth = 1
+        return  conn
+
+    def checkin(self, conn):
+        """Return connection to the pool, abandoning any uncommitted changes"""
+        if getattr(self.local, 'conn', None) is not conn:
+            raise dbopsError("Returning database connection not held by thread")
+        self.local.depth -= 1
+        if self.local.depth > 0:
+            return
+        self.local.conn = None
+        try:
+            conn.rollback()
+        except pymysql.Error:
+            pass
+        with self.cond:
+            self.idle.append(conn)
+            self.active -= 1
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Context manager giving lock-checking cursor on checked out connection
+        which goes back to the pool on exit"""
+        conn = self.checkout()
+        try:
+            curs = DBops_cursor(conn.cursor())
+            try:
+                yield curs
+            finally:
+                curs.close()
+        finally:
+            self.checkin(conn)
+
+    def stats(self):
+        """Return dictionary of pool metrics"""
+        with self.cond:
+            return  dict(size=self.size, created=self.created, active=self.active, idle=len(self.idle),
+                         checkouts=self.checkouts, waittime=self.waittime, maxwait=self.maxwait, reconnects=self.reconnects)
+
+    def close(self):
+        """Close all idle connections"""
+        with self.cond:
+            for conn in self.idle:
+                conn.close()
+            self.created -= len(self.idle)
+            self.idle = []
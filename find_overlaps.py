@@ -1,16 +1,49 @@
 """Find overlaps in list of x,y points and given radius"""
 
+import math
 import numpy as np
 
+
+class GridHash:
+    """Points hashed by grid cell with side of the distance we test so only neighbouring cells need looking at"""
+
+    def __init__(self, dist):
+        self.dist = dist
+        self.distsq = dist ** 2
+        self.cellsize = max(dist, 1e-9)
+        self.cells = dict()
+        self.count = 0
+
+    def cell(self, x, y):
+        """Get cell for point"""
+        return  (math.floor(x / self.cellsize), math.floor(y / self.cellsize))
+
+    def add(self, x, y):
+        """Add point"""
+        self.cells.setdefault(self.cell(x, y), []).append((x, y))
+        self.count += 1
+
+    def near(self, x, y):
+        """Report whether any point already added is within the distance of x,y"""
+        cx, cy = self.cell(x, y)
+        for nx in (cx - 1, cx, cx + 1):
+            for ny in (cy - 1, cy, cy + 1):
+                for px, py in self.cells.get((nx, ny), ()):
+                    if (px - x) ** 2 + (py - y) ** 2 <= self.distsq:
+                        return  True
+        return  False
+
+
 def find_overlaps(xypoints, apsize):
-    """Find indices of overlaps in a list of xy points within given radius"""
-
-    carr = np.array([complex(x,y) for x,y in xypoints])
-    side = carr.shape[0]
-    diffs = np.abs(np.subtract.outer(carr, carr)) > 2*apsize + 1
-    nooverlaps = np.full(side, True, dtype=bool)
-    for rownum, row in enumerate(diffs, 1):
-        nooverlaps[rownum:] &= row[rownum:]
-    if np.count_nonzero(nooverlaps) == side:
-        return  np.array(xypoints)
-    return  np.array(xypoints)[nooverlaps]
+    """Find indices of overlaps in a list of xy points within given radius.
+    Return array of points not overlapping any earlier point in the list"""
+
+    points = np.array(xypoints)
+    grid = GridHash(2*apsize + 1)
+    nooverlaps = np.full(len(points), True, dtype=bool)
+    for n, (x, y) in enumerate(points.tolist()):
+        nooverlaps[n] = not grid.near(x, y)
+        grid.add(x, y)
+    if np.count_nonzero(nooverlaps) == len(points):
+        return  points
+    return  points[nooverlaps]
@@ -1,19 +1,27 @@
 """Classes for reesult finding as XML"""
 
 import math
+import os
+import concurrent.futures
 # import sys
 import numpy as np
+from scipy import ndimage
 # import matplotlib.pyplot as plt
 # from matplotlib import colors
-import scipy.optimize as opt
 import objident
 import objdata
+import dbops
 import gauss2d
 import apoffsets
 import find_overlaps
+import remdefaults
+import remfits
+import objcatalogue
 
 DEFAULT_SIGN = 1.5
 DEFAULT_TOTSIGN = .75
+DEFAULT_SAVEBATCH = 20
+DEFAULT_BKGMESH = 64
 
 class FindResultErr(Exception):
     """"Throw if error faound option to retry without looking for offset"""
@@ -30,6 +38,7 @@ class FindResult:
                     radeg='f', decdeg='f', amp='f', sigma='f', ampstd='f', sigmastd='f', apsize='f',
                     adus='f', modadus='f', hide='b')
     frformats = dict(d='{:d}', f="{:.16e}", b="{:d}")
+    frconv = dict(d=int, f=float, b=int)
 
     def __init__(self, obj = None, objind = None, obsind = None, apsize = 0.0, ind = None):
         self.col = self.row = None
@@ -128,17 +137,11 @@ class FindResult:
                 Wh = "objind={:d} AND obsind={:d}".format(objind, obsind)
             except TypeError:
                 raise FindResultErr("Attempting to load findresult with no objind and obsind")
-        fields = FindResult.frfields.keys()
-        dbcurs.execute("SELECT " + ",".join(fields) + " FROM findresult WHERE " + Wh)
+        dbcurs.execute("SELECT " + ",".join(FindResult.frfields.keys()) + " FROM findresult WHERE " + Wh)
         r = dbcurs.fetchone()
         if r is None:
             raise FindResultErr("Expecting findresult record")
-        for f,val in zip(fields,r):
-            # Have to change "nrow" and "ncol" to "row" and "col"
-            non = f
-            if non[0] == 'n':
-                non = non[1:]
-            setattr(self, non, val)
+        self.load_row(r)
         if obj is None and self.ind is not None:
             self.obj = objdata.ObjData()
             self.obj.get(dbcurs, ind=self.objind)
@@ -146,6 +149,15 @@ class FindResult:
             self.obj.ra = self.radeg
             self.obj.dec = self.decdeg
 
+    def load_row(self, row):
+        """Set fields from database row in order of frfields"""
+        for f, val in zip(FindResult.frfields.keys(), row):
+            # Have to change "nrow" and "ncol" to "row" and "col"
+            non = f
+            if non[0] == 'n':
+                non = non[1:]
+            setattr(self, non, val)
+
     def savedb(self, dbcurs):
         """Save record to database (provides for non-identified things)"""
 
@@ -157,6 +169,15 @@ class FindResult:
             dbchanges += dbcurs.execute("DELETE FROM aducalc WHERE objind={:d} AND obsind={:d}".format(self.objind, self.obsind))
             dbchanges += dbcurs.execute("DELETE FROM findresult WHERE objind={:d} AND obsind={:d}".format(self.objind, self.obsind))
 
+        cols, vals = self.dbfields()
+        dbchanges += dbcurs.execute("INSERT INTO findresult (" + ",".join(cols) + ") VALUES (" + ",".join(["%s"] * len(cols)) + ")", vals)
+        self.ind = dbcurs.lastrowid
+        if dbchanges > 0:
+            # print(dbchanges, "DB changes")
+            dbcurs.connection.commit()
+
+    def dbfields(self):
+        """Get tuple of list of fields to save and list of values as parameters"""
         cols = []
         vals = []
         for field, typ in FindResult.frfields.items():
@@ -168,16 +189,11 @@ class FindResult:
                 continue
             # Give invalid code for things we don't want to save like ind
             try:
-                vals.append(FindResult.frformats[typ].format(val))
+                vals.append(FindResult.frconv[typ](val))
             except KeyError:
                 continue
             cols.append(field)
-
-        dbchanges += dbcurs.execute("INSERT INTO findresult (" + ",".join(cols) + ") VALUES (" + ",".join(vals) + ")")
-        self.ind = dbcurs.lastrowid
-        if dbchanges > 0:
-            # print(dbchanges, "DB changes")
-            dbcurs.connection.commit()
+        return  (cols, vals)
 
     def makesave(self):
         """Create a values block for a block save"""
@@ -261,6 +277,7 @@ class FindResults:
         self.pixrows = self.pixcols = self.minrow = self.mincol = self.maxrow = self.maxcol = 0
         self.maskpoints = self.skylevpoints = self.min_singlepix = self.min_apertureadus = 0.0
         self.exprow = self.expcol = self.currentap = self.currentiap = self.apsq = 0
+        self.closelist = self.closegrid = None
 
     def num_results(self, idonly=False, nohidden=False):
         """Return number of find results, if idonly is True, limit to ones identified"""
@@ -316,10 +333,15 @@ class FindResults:
     def tooclose(self, row, col, existing):
         """Reject possible if too close to existing one"""
 
-        for r, c, dummy in existing:
-            if (r - row) ** 2 + (c - col) ** 2 <= 4 * self.apsq:
-                return True
-        return False
+        # Keep grid of existing ones, adding to it as the caller adds to the list
+
+        dist = 2.0 * math.sqrt(self.apsq)
+        if self.closelist is not existing or self.closegrid.count > len(existing) or self.closegrid.dist != dist:
+            self.closelist = existing
+            self.closegrid = find_overlaps.GridHash(dist)
+        for r, c, dummy in existing[self.closegrid.count:]:
+            self.closegrid.add(r, c)
+        return  self.closegrid.near(row, col)
 
     def get_targobj(self):
         """Get target object, which we assume to be sorted to the front"""
@@ -335,7 +357,7 @@ class FindResults:
         n = 0
         base = ord('a')
         for r in self.resultlist:
-            if not r.obj.valid_label() or r.not_identified():
+            if r.not_identified() or not r.obj.valid_label():
                 l = chr(base + n % 26)
                 if n >= 26:
                     l += str(n // 26)
@@ -386,18 +408,30 @@ class FindResults:
 
         self.min_singlepix = self.remfitsobj.meanval + self.signif * self.remfitsobj.stdval
 
+    def singlepix_mask(self, searchp, dseg):
+        """Get mask of pixels at or above min_singlepix with at least searchp.minsingpix such pixels around them"""
+        signif = dseg >= self.min_singlepix
+        around = ndimage.correlate(signif.astype(np.float64), self.spmask, mode='constant', cval=0.0)
+        return  signif & (around >= searchp.minsingpix)
+
     def prune_singlepix(self, searchp, dseg, yxcoords):
         """Prune case where minimum level of pixels around a given pixel"""
-
-        newresult = []
-        drows, dcols = dseg.shape
-
-        for y, x in yxcoords:
-            if y <= 0 or y >= drows or x <= 0 or x >= dcols:
-                continue
-            if np.count_nonzero(dseg[y-1:y+1,x-1:x+1] >= self.min_singlepix) >= searchp.min_singlepix:
-                newresult.append((y,x))
-        return  newresult
+        mask = self.singlepix_mask(searchp, dseg)
+        return  [(y, x) for y, x in yxcoords if mask[y, x]]
+
+    def peak_centres(self, searchp, dseg, apsize):
+        """Get array of (row, col) centres of local maxima in dseg passing the single pixel test,
+        brightest first, dropping any overlapping a brighter one"""
+        good = self.singlepix_mask(searchp, dseg)
+        if not np.any(good):
+            return  np.empty((0, 2))
+        size = 2 * int(apsize) + 1
+        peaks = good & (dseg == ndimage.maximum_filter(dseg, size=size, mode='constant', cval=-np.inf))
+        labels, npeaks = ndimage.label(peaks)
+        index = np.arange(1, npeaks + 1)
+        centres = np.array(ndimage.center_of_mass(dseg, labels, index)).reshape(-1, 2)
+        heights = np.asarray(ndimage.maximum(dseg, labels, index))
+        return  find_overlaps.find_overlaps(centres[np.argsort(-heights, kind='stable')], apsize)
 
     def get_aperture_data(self, row, column):
         """Get data in aperture according to mask"""
@@ -408,40 +442,34 @@ class FindResults:
         """Calculate the total ADUs based arount the given row and column"""
         return  np.sum(self.get_aperture_data(row, column)) - self.skylevpoints
 
-    def find_object(self, row, col, obj, searchp):
-        """Fins specific object from expected place NB row and col might be fractional"""
+    def obj_params(self, row, col, obj, searchp):
+        """Get aperture size, limit of shift, whether target and name for messages
+        for object expected at row and col, obj being None for ones not identified"""
+        if obj is None:
+            return  (searchp.defapsize, searchp.defapsize + searchp.maxshift2, False, "peak at ({:.1f},{:.1f})".format(col, row))
         apsize = obj.apsize
         if apsize == 0:
             apsize = searchp.defapsize
-        self.signif = searchp.signif
-        self.get_image_dims(apsize)
 
         # This is the limit of the grid we look in
-        lim = apsize + searchp.maxshift2
-        ist = False
         if obj.is_target():
-            ist = True
-            lim = apsize + searchp.maxshift
+            return  (apsize, apsize + searchp.maxshift, True, obj.dispname)
+        return  (apsize, apsize + searchp.maxshift2, False, obj.dispname)
+
+    def find_object(self, row, col, obj, searchp):
+        """Fins specific object from expected place NB row and col might be fractional"""
+        apsize, lim, ist, name = self.obj_params(row, col, obj, searchp)
+        self.signif = searchp.signif
+        self.get_image_dims(apsize)
 
         colfrac, scol = math.modf(col)
         rowfrac, srow = math.modf(row)
         scol = int(scol)
         srow = int(srow)
-        xypixoffsets = apoffsets.ap_offsets(col, row, apsize)
-        xypixes = xypixoffsets + (scol, srow)
-        # print("xypixes shape", xypixes.shape, "val", xypixes)
-        xpixes = xypixes[:,0]
-        ypixes = xypixes[:,1]
-        if xpixes.min() < self.mincol:
-            raise FindResultErr("Cannot find {:s}, too close to left edge".format(obj.dispname))
-        if xpixes.max() >= self.maxcol:
-            raise FindResultErr("Cannot find {:s}, too close to right edge".format(obj.dispname))
-        if ypixes.min() < self.minrow:
-            raise FindResultErr("Cannot find {:s}, too close to bottom edge".format(obj.dispname))
-        if ypixes.max() >= self.maxrow:
-            raise FindResultErr("Cannot find {:s}, too close to top edge".format(obj.dispname))
-
-        datavals = np.array([self.imagedata[y, x] for x, y in xypixes]) # NB Sky level subtracted
+        try:
+            xypixoffsets, (datavals, ) = apoffsets.ap_gather(col, row, apsize, (self.imagedata, ), (self.mincol, self.maxcol, self.minrow, self.maxrow)) # NB Sky level subtracted
+        except apoffsets.ApOffsetsErr as e:
+            raise FindResultErr("Cannot find {:s}, too close to {:s} edge".format(name, e.edge))
 
         # Normalise data values to 1 as fitting works better that way
 
@@ -450,16 +478,22 @@ class FindResults:
 
         # print("Pixoffsets", xypixoffsets, "scol/srow", scol, srow, "col/rowfrac", colfrac, rowfrac)
         try:
-            lresult, lfiterrs = opt.curve_fit(gauss2d.gauss_circle, xypixoffsets, ndatavals, p0=(colfrac, rowfrac, ndatavals.max(), np.std(ndatavals)))
+            lresult, lfiterrs = gauss2d.fit_gauss_circle(xypixoffsets, ndatavals, (colfrac, rowfrac, ndatavals.max(), np.std(ndatavals)))
         except (TypeError, RuntimeError):
-            raise  FindResultErr("Unable to find {:s}".format(obj.dispname))
+            raise  FindResultErr("Unable to find {:s}".format(name))
+
+        return  self.make_result(row, col, obj, apsize, lim, ist, name, lresult, lfiterrs, datavals, meanv, searchp)
 
+    def make_result(self, row, col, obj, apsize, lim, ist, name, lresult, lfiterrs, datavals, meanv, searchp):
+        """Make FindResult from fit to normalised data, raising FindResultErr if not acceptable"""
+        scol = int(col)
+        srow = int(row)
         fr = FindResult(obj=obj, apsize=apsize)
         cdiff, rdiff, fr.amp, fr.sigma = lresult
         # print("After fit cdiff={:.4f} rdiff={:.4f} amp={:.4f} sigma={:.4f}".format(*lresult))
         fr.xoffstd, fr.yoffstd, fr.ampstd, fr.sigmastd = np.diag(lfiterrs)
         if fr.xoffstd > searchp.offsetsig or fr.yoffstd > searchp.offsetsig:
-            raise FindResultErr("Too great an offset error finding {:s} x={:.4g} y={:.4g}".format(obj.dispname, fr.xoffstd, fr.yoffstd), True)
+            raise FindResultErr("Too great an offset error finding {:s} x={:.4g} y={:.4g}".format(name, fr.xoffstd, fr.yoffstd), True)
 
         # Restore from normalisation
 
@@ -467,7 +501,7 @@ class FindResults:
         fr.ampstd *= meanv
 
         if fr.amp <= 0.0 or fr.ampstd <= 0 or fr.amp < fr.ampstd * searchp.ampsig or fr.sigma < fr.sigmastd * searchp.sigmasig:
-            raise FindResultErr("Unable to find {:s} - too much error stderr amp {:.4g} sigma {:.4g}".format(obj.dispname, fr.ampstd, fr.sigmastd))
+            raise FindResultErr("Unable to find {:s} - too much error stderr amp {:.4g} sigma {:.4g}".format(name, fr.ampstd, fr.sigmastd))
 
         # The returned values of cdiff and rdiff are offsets from scol and srow
         # Set cdiff and rdiff in structure to where we expected them to be minus where they are
@@ -476,12 +510,13 @@ class FindResults:
         fr.row = srow + rdiff
         fr.cdiff = col - fr.col
         fr.rdiff = row - fr.row
-        fr.radeg = obj.ra
-        fr.decdeg = obj.dec
+        if obj is not None:
+            fr.radeg = obj.ra
+            fr.decdeg = obj.dec
         fr.istarget = ist
 
         if abs(fr.cdiff) > lim or abs(fr.rdiff) >= lim:
-            raise FindResultErr("Unable to find {:s} - too much shift cdiff={:.2f} rdiff={:.2f}".format(obj.dispname, fr.cdiff, fr.rdiff))
+            raise FindResultErr("Unable to find {:s} - too much shift cdiff={:.2f} rdiff={:.2f}".format(name, fr.cdiff, fr.rdiff))
 
         # Now calculate ADUs from data and from fit
 
@@ -489,6 +524,98 @@ class FindResults:
         fr.calculate_mod_integral()
         return  fr
 
+    def find_objects(self, objposlist, searchp):
+        """Find list of objects in the frame as find_object does, objposlist being a list
+        of (row, col, obj) for the expected places, obj being None for ones not identified.
+        All the fits are done together, falling back to find_object for any which don't converge.
+        Return list in the same order of FindResult or the FindResultErr for ones not found"""
+
+        self.signif = searchp.signif
+        self.get_image_dims(searchp.defapsize)
+        results = [None] * len(objposlist)
+        fits = []
+        for n, (row, col, obj) in enumerate(objposlist):
+            apsize, lim, ist, name = self.obj_params(row, col, obj, searchp)
+            iap = int(math.floor(apsize))
+            try:
+                xypixoffsets, (datavals, ) = apoffsets.ap_gather(col, row, apsize, (self.imagedata, ), (iap + 1, self.pixcols - iap, iap + 1, self.pixrows - iap))
+            except apoffsets.ApOffsetsErr as e:
+                results[n] = FindResultErr("Cannot find {:s}, too close to {:s} edge".format(name, e.edge))
+                continue
+            fits.append((n, row, col, obj, apsize, lim, ist, name, xypixoffsets, datavals))
+
+        if len(fits) != 0:
+            maxpix = max(len(f[-1]) for f in fits)
+            pts = np.zeros((len(fits), maxpix, 2))
+            ndatavals = np.zeros((len(fits), maxpix))
+            mask = np.zeros((len(fits), maxpix), dtype=bool)
+            p0 = np.zeros((len(fits), 4))
+            meanvs = np.zeros(len(fits))
+            for f, (n, row, col, obj, apsize, lim, ist, name, xypixoffsets, datavals) in enumerate(fits):
+                npix = len(datavals)
+                meanvs[f] = datavals.mean()
+                nd = datavals / meanvs[f]
+                pts[f, :npix] = xypixoffsets
+                ndatavals[f, :npix] = nd
+                mask[f, :npix] = True
+                p0[f] = (math.modf(col)[0], math.modf(row)[0], nd.max(), np.std(nd))
+
+            popt, pcov, converged = gauss2d.fit_gauss_circles(pts, ndatavals, mask, p0)
+
+            for f, (n, row, col, obj, apsize, lim, ist, name, xypixoffsets, datavals) in enumerate(fits):
+                try:
+                    if converged[f]:
+                        results[n] = self.make_result(row, col, obj, apsize, lim, ist, name, popt[f], pcov[f], datavals, meanvs[f], searchp)
+                    else:
+                        results[n] = self.find_object(row, col, obj, searchp)
+                except FindResultErr as e:
+                    results[n] = e
+
+        return  results
+
+    def background_map(self, mesh=DEFAULT_BKGMESH):
+        """Get map of background left in sky-subtracted image from medians over mesh x mesh boxes
+        interpolated back to the image size"""
+        nbrows = max(1, self.pixrows // mesh)
+        nbcols = max(1, self.pixcols // mesh)
+        brows = self.pixrows // nbrows
+        bcols = self.pixcols // nbcols
+        boxes = self.imagedata[:nbrows * brows, :nbcols * bcols].reshape(nbrows, brows, nbcols, bcols)
+        meds = np.median(boxes.transpose(0, 2, 1, 3).reshape(nbrows, nbcols, -1), axis=2)
+        if nbrows == 1 and nbcols == 1:
+            return  np.full(self.imagedata.shape, meds[0, 0])
+        return  ndimage.zoom(meds, (self.pixrows / nbrows, self.pixcols / nbcols), order=1, mode='nearest', grid_mode=True)
+
+    def extract_all(self, searchp, mesh=DEFAULT_BKGMESH):
+        """Find every significant source in the frame without reference to the catalogue.
+        Background left after sky subtraction is taken out and local peaks at least signif
+        standard deviations above it and passing the single pixel test are fitted together.
+        Return new FindResults of unidentified results brightest first"""
+
+        self.signif = searchp.signif
+        self.get_image_dims(searchp.defapsize)
+        resid = self.imagedata - self.background_map(mesh)
+        noise = 1.4826 * np.median(np.abs(resid - np.median(resid)))
+        self.min_singlepix = searchp.signif * noise
+        ret = FindResults(self.remfitsobj)
+        centres = self.peak_centres(searchp, resid, searchp.defapsize)
+        if len(centres) == 0:
+            return  ret
+
+        for fr in self.find_objects([(row, col, None) for row, col in centres], searchp):
+            if isinstance(fr, FindResult):
+                fr.obsind = self.obsind
+                ret.append_result(fr)
+        if ret.num_results() != 0 and self.remfitsobj.wcs is not None:
+            radecs = self.remfitsobj.wcs.pix_to_coords([(fr.col, fr.row) for fr in ret.results()])
+            for fr, (ra, dec) in zip(ret.results(), radecs):
+                fr.radeg = ra
+                fr.decdeg = dec
+        ret.reorder()
+        ret.relabel()
+        ret.rekey()
+        return  ret
+
     def find_peak(self, row, col, possobj, searchp):
         """Find peak for when we are giving a label to an object"""
         if possobj.apsize == 0:
@@ -499,26 +626,13 @@ class FindResults:
         startrow = int(math.floor(max(row - searchp.maxshift, self.minrow)))
         startcol = int(math.floor(max(col - searchp.maxshift, self.mincol)))
         endrow = int(math.ceil(min(row + searchp.maxshift, self.maxrow)))
-        endcol = int(math.ceil(min(col + searchp.maxshift, self.mincol)))
-        numcols = endcol - startcol
+        endcol = int(math.ceil(min(col + searchp.maxshift, self.maxcol)))
 
         dataseg = self.imagedata[startrow:endrow, startcol:endcol]
-        fimage = dataseg.flatten()
-        order = fimage.argsort()[::-10]
-        vals = fimage[order]
-        signifs = order[vals >= self.min_singlepix]
-        if len(signifs) == 0:
-            return  None
-
-        # Comvert to list of row,col coords
-        yxvals = [(v // numcols, v % numcols) for v in signifs]
-
-        # Prune single pixels out
-
-        yxvals = self.prune_singlepix(searchp, dataseg, yxvals)
+        yxvals = self.peak_centres(searchp, dataseg, possobj.apsize)
         if len(yxvals) == 0:
             return  None
-        yxvals = find_overlaps.find_overlaps(yxvals, possobj.apsize) + (startcol, startrow)
+        yxvals += (startrow, startcol)
         fitresults = []
 
         for y, x in yxvals:
@@ -560,9 +674,7 @@ class FindResults:
         results = []
 
         for possap in np.arange(minap, maxap + step, step):
-            xycoords = apoffsets.ap_offsets(col, row, possap)
-            #print("xycoords", xycoords, "possap", possap)
-            datavals = np.array([self.imagedata[y,x] for x,y in xycoords+(scol,srow)])
+            xycoords, (datavals, ) = apoffsets.ap_gather(col, row, possap, (self.imagedata, ))
             #print("datavals", datavals)
             # Can't do curve fit with less than 4 points.
             if datavals.size <= 4:
@@ -570,7 +682,7 @@ class FindResults:
             meanv = datavals.mean()
             datavals /= meanv
             try:
-                lresult, lfiterrs = opt.curve_fit(gauss2d.gauss_circle, xycoords, datavals, p0=(col-scol, row-srow, max(datavals), np.std(datavals)))
+                lresult, lfiterrs = gauss2d.fit_gauss_circle(xycoords, datavals, (col-scol, row-srow, max(datavals), np.std(datavals)))
             except (TypeError, RuntimeError):
                 continue
             fr = FindResult(apsize=possap)
@@ -711,13 +823,13 @@ class FindResults:
 
     def adjust_offsets(self, dbcurs, rowdiff, coldiff):
         """Adjust row and column difference fields after we've adjusted that for obs"""
-        donefr = 0
+        updates = []
         for fr in self.resultlist:
             fr.rdiff += rowdiff
             fr.cdiff += coldiff
             if fr.ind is not None:
-                donefr += dbcurs.execute("UPDATE findresult SET rdiff={:.4f},cdiff={:.4f} WHERE ind={:d}".format(fr.rdiff, fr.cdiff, fr.ind))
-        return  donefr
+                updates.append((fr.ind, float(fr.rdiff), float(fr.cdiff)))
+        return  dbops.update_many(dbcurs, "findresult", "ind", ("rdiff", "cdiff"), updates)
 
     def loaddb(self, dbcurs):
         """Load from database note assumes remfitsobj filled in"""
@@ -728,20 +840,32 @@ class FindResults:
 
         self.resultlist = []
 
-        dbcurs.execute("SELECT ind FROM findresult WHERE obsind={:d}".format(obsind))
-        frres = dbcurs.fetchall()
-        dbcurs.execute("SELECT filter,date_obs,nrows,ncols FROM obsinf WHERE obsind={:d}".format(obsind))
-        obsinf = dbcurs.fetchone()
-        if obsinf is None:
+        # Get obs info, find results and objects all in one go
+
+        frnames = list(FindResult.frfields.keys())
+        nfr = len(frnames)
+        indpos = frnames.index("ind")
+        dbcurs.execute("SELECT obsinf.filter,obsinf.date_obs,obsinf.nrows,obsinf.ncols," + \
+                       ",".join(["findresult." + f for f in frnames]) + "," + objdata.objdata_select("objdata") + \
+                       " FROM obsinf LEFT JOIN findresult ON findresult.obsind=obsinf.obsind" \
+                       " LEFT JOIN objdata ON objdata.ind=findresult.objind" \
+                       " WHERE obsinf.obsind={:d}".format(obsind))
+        rows = dbcurs.fetchall()
+        if len(rows) == 0:
             raise FindResultErr("No obsinf for obsind={:d}".format(obsind))
-        self.filter, self.obsdate, self.nrows, self.ncols = obsinf
+        self.filter, self.obsdate, self.nrows, self.ncols = rows[0][0:4]
         self.obsind = obsind
 
-        for frrind, in frres:
+        for row in rows:
+            frrow = row[4:4+nfr]
+            objrow = row[4+nfr:]
+            if frrow[indpos] is None:
+                continue
             fr = FindResult()
-            fr.loaddb(dbcurs, ind=frrind)
-            fr.obj = objdata.ObjData()
-            fr.obj.get(dbcurs, ind=fr.objind)
+            fr.load_row(frrow)
+            if objrow[0] is not None:
+                fr.obj = objdata.ObjData().load_row(objrow)
+                fr.istarget = fr.obj.is_target()
             self.resultlist.append(fr)
 
         self.reorder()
@@ -751,9 +875,42 @@ class FindResults:
     def savedb(self, dbcurs, delete_previous = False):
         """Save records to database leaving along previously unsave records unless delete_previous set"""
 
+        # Ones without object and obs inds go one at a time as we can't find the inds otherwise
+
+        bulk = []
         for fr in self.resultlist:
             if fr.ind is None or delete_previous:
-                fr.savedb(dbcurs)
+                if fr.objind is None or fr.obsind is None:
+                    fr.savedb(dbcurs)
+                else:
+                    bulk.append(fr)
+        if len(bulk) == 0:
+            return
+
+        inds = ",".join(["{:d}".format(fr.ind) for fr in bulk if fr.ind is not None])
+        pairs = ",".join(["({:d},{:d})".format(fr.objind, fr.obsind) for fr in bulk if fr.ind is None])
+        for table, indcol in (("aducalc", "frind"), ("findresult", "ind")):
+            wh = []
+            if len(inds) != 0:
+                wh.append(indcol + " IN (" + inds + ")")
+            if len(pairs) != 0:
+                wh.append("(objind,obsind) IN (" + pairs + ")")
+            dbcurs.execute("DELETE FROM " + table + " WHERE " + " OR ".join(wh))
+
+        # Group by fields saved as we leave out ones not set
+
+        groups = dict()
+        for fr in bulk:
+            cols, vals = fr.dbfields()
+            groups.setdefault(tuple(cols), []).append(vals)
+        for cols, rows in groups.items():
+            dbops.insert_many(dbcurs, "findresult", cols, rows)
+
+        dbcurs.execute("SELECT ind,objind,obsind FROM findresult WHERE (objind,obsind) IN (" + ",".join(["({:d},{:d})".format(fr.objind, fr.obsind) for fr in bulk]) + ")")
+        newinds = {(objind, obsind): ind for ind, objind, obsind in dbcurs.fetchall()}
+        for fr in bulk:
+            fr.ind = newinds.get((fr.objind, fr.obsind))
+        dbcurs.connection.commit()
 
     def save_as_block(self, dbcurs, blocksize = 512):
         """Save records as single blocks"""
@@ -768,3 +925,101 @@ class FindResults:
         if len(varr) != 0:
             dbcurs.execute("INSERT INTO findresult " + fields + ",".join(varr))
         dbcurs.connection.commit()
+
+
+# State kept by each worker process in run_frames
+
+worker_state = dict()
+
+
+def init_worker(dbname, catfile):
+    """Open database connection and load catalogue snapshot in worker process"""
+    dbase = dbops.opendb(dbname)
+    worker_state['dbase'] = dbase
+    worker_state['dbcurs'] = dbase.cursor()
+    worker_state['catalogue'] = objcatalogue.load_catalogue(worker_state['dbcurs'], catfile)
+
+
+def find_frame(obsind, searchp):
+    """Find catalogue objects in frame for obsind in worker process.
+    Return (obsind, FindResults) without the image or (obsind, exception) if we couldn't do it,
+    including where the target is unknown or the frame has no WCS"""
+    dbcurs = worker_state['dbcurs']
+    try:
+        remfitsobj = remfits.parse_filearg(str(obsind), dbcurs)
+        if remfitsobj.wcs is None:
+            raise remfits.RemFitsErr("No WCS for obsind {:d}".format(obsind))
+        remfitsobj.calc_skylevel()
+        objlist = worker_state['catalogue'].get_sky_region(dbcurs, remfitsobj)
+        dbcurs.connection.commit()
+        frs = FindResults(remfitsobj)
+        if len(objlist) != 0:
+            colrows = remfitsobj.wcs.coords_to_pix([(obj.ra, obj.dec) for obj in objlist])
+            for fr in frs.find_objects([(row, col, obj) for (col, row), obj in zip(colrows, objlist)], searchp):
+                if isinstance(fr, FindResult):
+                    fr.obsind = obsind
+                    frs.append_result(fr)
+        frs.reorder()
+        frs.relabel()
+        frs.rekey()
+    except (FindResultErr, remfits.RemFitsErr, objdata.ObjDataError) as e:
+        return  (obsind, e)
+    frs.remfitsobj = frs.imagedata = None
+    return  (obsind, frs)
+
+
+def save_batch(dbcurs, frslist):
+    """Save list of FindResults for different frames in one go"""
+    combined = FindResults()
+    for frs in frslist:
+        combined.resultlist += frs.resultlist
+    combined.savedb(dbcurs)
+
+
+def run_frames(obsinds, searchp, workers=None, dbname=None, catfile=None, savebatch=DEFAULT_SAVEBATCH):
+    """Find catalogue objects in each frame in obsinds spreading the frames across workers
+    processes (default number of CPUs) each with its own database connection and catalogue snapshot.
+    Results are saved as they come back savebatch frames at a time.
+    Return dictionary by obsind of FindResults or the exception (usually FindResultErr, RemFitsErr
+    or ObjDataError) for frames which failed.
+    If the run is aborted, results already back are still saved"""
+
+    if dbname is None:
+        dbname = remdefaults.default_database()
+    if workers is None:
+        workers = os.cpu_count()
+
+    # Bring the snapshot up to date first so the workers don't all do it
+
+    dbase = dbops.opendb(dbname)
+    dbcurs = dbase.cursor()
+    objcatalogue.load_catalogue(dbcurs, catfile)
+
+    report = dict()
+    pending = []
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(dbname, catfile))
+    try:
+        futures = {pool.submit(find_frame, obsind, searchp): obsind for obsind in obsinds}
+        for fut in concurrent.futures.as_completed(futures):
+            obsind = futures[fut]
+            try:
+                dummy, result = fut.result()
+            except Exception as e:              # pylint: disable=broad-except
+                result = e
+            report[obsind] = result
+            if isinstance(result, FindResults):
+                pending.append(result)
+                if len(pending) >= savebatch:
+                    batch, pending = pending, []
+                    save_batch(dbcurs, batch)
+    finally:
+
+        # If aborting don't wait for the frames not started yet
+
+        pool.shutdown(wait=True, cancel_futures=True)
+        try:
+            if len(pending) != 0:
+                save_batch(dbcurs, pending)
+        finally:
+            dbase.close()
+    return  report
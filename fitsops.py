@@ -6,29 +6,46 @@ import gzip
 import io
 from astropy.io import fits
 
+# Formats for saved FITS files, whole file gzipped or tile compressed in CompImageHDU
+
+FITS_GZIP = 'gzip'
+FITS_TILED = 'tiled'
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def fits_format(bytestring):
+    """Work out which format a saved FITS byte string is in"""
+    if bytestring[0:2] == GZIP_MAGIC:
+        return  FITS_GZIP
+    return  FITS_TILED
+
 
 def mem_open(bytestring, compressed=True):
-    """Open the given byte string as an in-memory FITS fite"""
+    """Open the given byte string as an in-memory FITS fite.
+    If compressed, decompress as we go rather than making a decompressed copy first
+    so we don't hold the compressed, decompressed and array data all at once"""
 
-    stream = bytestring
-    if compressed:
-        try:
-            stream = gzip.decompress(bytestring)
-        except OSError:
-            return None
+    stream = io.BytesIO(bytestring)
+    if compressed and fits_format(bytestring) == FITS_GZIP:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
     try:
-        return fits.open(io.BytesIO(stream), memmap=False, lazy_load_hdus=False)
-    except OSError:
+        return fits.open(stream, memmap=False, lazy_load_hdus=False)
+    except (OSError, EOFError):
         return None
 
 
 def mem_get(bytestring, compressed=True):
-    """Return header, data from in memory FITS file assuming just 1 HDU"""
+    """Return header, data from in memory FITS file assuming just 1 HDU
+    (or empty primary HDU followed by tile-compressed HDU)"""
     ff = mem_open(bytestring, compressed)
     if ff is None:
         return (None, None)
-    hdr = ff[0].header
-    data = ff[0].data
+    hdu = ff[0]
+    if hdu.data is None and len(ff) > 1 and isinstance(ff[1], fits.CompImageHDU):
+        hdu = ff[1]
+    hdr = hdu.header
+    data = hdu.data
     ff.close()
     return (hdr, data)
 
@@ -43,3 +60,22 @@ def mem_makefits(hdr, data, compressed=True):
     if compressed:
         bytestring = gzip.compress(stream)
     return bytestring
+
+
+def mem_maketiled(hdr, data):
+    """Generate new tile-compressed FITS file in memory from header and data.
+    Use RICE for integer data and lossless GZIP for floating point"""
+    if data.dtype.kind in 'iu':
+        hdu = fits.CompImageHDU(data, hdr, compression_type='RICE_1')
+    else:
+        hdu = fits.CompImageHDU(data, hdr, compression_type='GZIP_2', quantize_level=0.0)
+    mm = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(mm)
+    return mm.getvalue()
+
+
+def mem_makesaved(hdr, data, fmt=FITS_GZIP):
+    """Generate FITS file in memory in given saved format"""
+    if fmt == FITS_TILED:
+        return mem_maketiled(hdr, data)
+    return mem_makefits(hdr, data)
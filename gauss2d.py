@@ -1,6 +1,7 @@
 """Two-dimensional Gaussians"""
 
 import numpy as np
+import scipy.optimize as opt
 
 def gauss2d(xpts, ypts, amp, sigma):
     """Compute gaussian from similar-shapped x and y"""
@@ -9,12 +10,27 @@ def gauss2d(xpts, ypts, amp, sigma):
 def gauss_circle(pts, xoffset, yoffset, amp, sigma):
     """Compute 2D gaussian with given amplitude and sigma
     pts is a tuple of x and y points"""
-    return gauss2d(pts[:,1] - xoffset, pts[:,0] - yoffset, amp, sigma)
+    return gauss2d(pts[:,0] - xoffset, pts[:,1] - yoffset, amp, sigma)
+
+def gauss_circle_jac(pts, xoffset, yoffset, amp, sigma):
+    """Compute Jacobian of gauss_circle with respect to the parameters"""
+    xpts = pts[:,0] - xoffset
+    ypts = pts[:,1] - yoffset
+    rsq = xpts**2 + ypts**2
+    sigsq = sigma ** 2
+    E = np.exp(rsq / (-2.0 * sigsq))
+    G = amp * E
+    return  np.column_stack((G * xpts / sigsq, G * ypts / sigsq, E, G * rsq / (sigsq * sigma)))
+
+def fit_gauss_circle(pts, datavals, p0):
+    """Fit gauss_circle to data using analytic Jacobian, returning (popt, pcov) as curve_fit does
+    and raising TypeError or RuntimeError in the same way"""
+    return  opt.curve_fit(gauss_circle, pts, datavals, p0=p0, jac=gauss_circle_jac)
 
 def gauss_with_error(pts, xoffset, yoffset, amp, sigma, ampsig, sigmasig):
     """Compute 2D gaussian with error term"""
-    xpts = pts[:,1] - xoffset
-    ypts = pts[:,0] - yoffset
+    xpts = pts[:,0] - xoffset
+    ypts = pts[:,1] - yoffset
     G = gauss2d(xpts, ypts, amp, sigma)
     VG = G**2 * ((ampsig/amp)**2 + sigmasig**2 * (xpts**2 + ypts**2)**2/sigma**6)
     return  (G, np.sqrt(VG))
@@ -22,6 +38,108 @@ def gauss_with_error(pts, xoffset, yoffset, amp, sigma, ampsig, sigmasig):
 def lorentz_circle(pts, xoffset, yoffset, gamma):
     """Compute 2D lorentz with given gamma
     pts is a tuple of x and y points"""
-    xpt = pts[:,1] - xoffset
-    ypt = pts[:,0] - yoffset
+    xpt = pts[:,0] - xoffset
+    ypt = pts[:,1] - yoffset
     return  (0.5 / np.pi) * gamma / (xpt**2 + ypt**2 + gamma**2)**1.5
+
+def lorentz_circle_jac(pts, xoffset, yoffset, gamma):
+    """Compute Jacobian of lorentz_circle with respect to the parameters"""
+    xpt = pts[:,0] - xoffset
+    ypt = pts[:,1] - yoffset
+    dsq = xpt**2 + ypt**2 + gamma**2
+    L = (0.5 / np.pi) / dsq**1.5
+    D = 3.0 * gamma * L / dsq
+    return  np.column_stack((D * xpt, D * ypt, L - gamma * D))
+
+def fit_lorentz_circle(pts, datavals, p0):
+    """Fit lorentz_circle to data using analytic Jacobian, returning (popt, pcov) as curve_fit does"""
+    return  opt.curve_fit(lorentz_circle, pts, datavals, p0=p0, jac=lorentz_circle_jac)
+
+def gauss_circles_resid_jac(pts, datavals, wts, p):
+    """Get residuals, Jacobian and sum of squares of gauss_circle for sets of points
+    pts (N, maxpix, 2), data values (N, maxpix) and weights 0 or 1 (N, maxpix) against parameters (N, 4)"""
+    dx = pts[...,0] - p[:,0,np.newaxis]
+    dy = pts[...,1] - p[:,1,np.newaxis]
+    rsq = dx**2 + dy**2
+    sigma = p[:,3,np.newaxis]
+    sigsq = sigma ** 2
+    E = np.exp(rsq / (-2.0 * sigsq))
+    G = p[:,2,np.newaxis] * E
+    r = (G - datavals) * wts
+    J = np.stack((G * dx / sigsq, G * dy / sigsq, E, G * rsq / (sigsq * sigma)), axis=-1) * wts[...,np.newaxis]
+    return  (r, J, np.sum(r**2, axis=1))
+
+def fit_gauss_circles(pts, datavals, mask, p0, maxiter=200, ftol=1.49012e-08, xtol=1.49012e-08):
+    """Fit gauss_circle to N sets of points at once by Levenberg-Marquardt.
+    pts is (N, maxpix, 2), datavals (N, maxpix) and mask (N, maxpix) boolean giving
+    which points are used, p0 is (N, 4).
+    Return (popt, pcov, converged) with popt (N, 4), pcov (N, 4, 4) scaled as curve_fit
+    does and converged a boolean array, False where the fit failed or the covariance
+    couldn't be estimated"""
+
+    npar = 4
+    p = np.array(p0, dtype=np.float64)
+    nfits = p.shape[0]
+    wts = mask.astype(np.float64)
+    npts = wts.sum(axis=1)
+    eye = np.eye(npar)
+    converged = np.zeros(nfits, dtype=bool)
+    pcov = np.full((nfits, npar, npar), np.inf)
+
+    with np.errstate(all='ignore'):
+        r, J, cost = gauss_circles_resid_jac(pts, datavals, wts, p)
+        lam = np.full(nfits, 1e-3)
+        active = np.flatnonzero((npts > npar) & np.isfinite(cost))
+
+        for dummy in range(maxiter):
+            if len(active) == 0:
+                break
+            aJ = J[active]
+            A = np.einsum('nmi,nmj->nij', aJ, aJ)
+            g = np.einsum('nmi,nm->ni', aJ, r[active])
+            damped = A + lam[active,np.newaxis,np.newaxis] * (A * eye + eye * 1e-12)
+            ok = np.ones(len(active), dtype=bool)
+            try:
+                step = -np.linalg.solve(damped, g[...,np.newaxis])[...,0]
+            except np.linalg.LinAlgError:
+                step = np.zeros_like(g)
+                for n in range(len(active)):
+                    try:
+                        step[n] = -np.linalg.solve(damped[n], g[n])
+                    except np.linalg.LinAlgError:
+                        ok[n] = False
+            oldp = p[active]
+            newp = oldp + step
+            newr, newJ, newcost = gauss_circles_resid_jac(pts[active], datavals[active], wts[active], newp)
+            oldcost = cost[active]
+            better = ok & np.isfinite(newcost) & (newcost <= oldcost)
+
+            # Only test convergence on steps which are close to Gauss-Newton as heavily damped steps are always small
+
+            small = better & (lam[active] <= 1.0) & ((oldcost - newcost <= ftol * oldcost) |
+                                                     (np.sqrt(np.sum(step**2, axis=1)) <= xtol * (xtol + np.sqrt(np.sum(oldp**2, axis=1)))))
+            bind = active[better]
+            p[bind] = newp[better]
+            r[bind] = newr[better]
+            J[bind] = newJ[better]
+            cost[bind] = newcost[better]
+            lam[bind] /= 10.0
+            lam[active[~better]] *= 10.0
+            converged[active[small]] = True
+            active = active[ok & ~small & (lam[active] < 1e16)]
+
+        for n in np.flatnonzero(converged):
+            try:
+                pcov[n] = np.linalg.inv(np.dot(J[n].T, J[n])) * cost[n] / (npts[n] - npar)
+            except np.linalg.LinAlgError:
+                converged[n] = False
+        converged &= np.all(np.isfinite(pcov), axis=(1,2)) & np.all(np.isfinite(p), axis=1)
+
+    # Sigma only appears squared so make it positive
+
+    neg = p[:,3] < 0
+    p[neg,3] *= -1.0
+    pcov[neg,3,:] *= -1.0
+    pcov[neg,:,3] *= -1.0
+
+    return  (p, pcov, converged)
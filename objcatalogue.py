@@ -0,0 +1,172 @@
+"""In-memory copy of object catalogue with spatial lookup"""
+
+import os
+import pickle
+import tempfile
+import numpy as np
+from scipy.spatial import cKDTree
+import remdefaults
+import objdata
+
+DEFAULT_SNAPSHOT = "objcatalogue.snapshot"
+SNAPSHOT_VERSION = 1
+
+
+class ObjCatalogueErr(Exception):
+    """Throw if we have problems with the catalogue"""
+
+
+def change_counter(dbcurs):
+    """Get value which changes when objdata changes to check snapshot is up to date,
+    covering all the fields saved in the snapshot"""
+    dbcurs.execute("SELECT COUNT(*),MAX(ind),SUM(CRC32(CONCAT_WS(','," + objdata.objdata_select() + "))) FROM objdata WHERE suppress=0")
+    return  tuple(str(v) for v in dbcurs.fetchone())
+
+
+def unit_vectors(ras, decs):
+    """Convert arrays of RA and DEC in degrees to unit vectors"""
+    rar = np.radians(ras)
+    decr = np.radians(decs)
+    cosdec = np.cos(decr)
+    return  np.column_stack((cosdec * np.cos(rar), cosdec * np.sin(rar), np.sin(decr)))
+
+
+def ra_range(ras):
+    """Get minimum and maximum RA of set of RAs allowing for wrap around at 0.
+    Minimum is greater than maximum if it wraps"""
+    ras = np.asarray(ras) % 360.0
+    minra = ras.min()
+    maxra = ras.max()
+    if maxra - minra <= 180.0:
+        return  (minra, maxra)
+    return  (ras[ras > 180.0].min(), ras[ras <= 180.0].max())
+
+
+class ObjCatalogue:
+    """Columnar copy of non-suppressed objects with spatial index"""
+
+    def __init__(self):
+        self.counter = None
+        self.rows = []
+        self.inds = self.names = self.vicinities = None
+        self.ras = self.decs = self.variabilities = self.usables = None
+        self.decorder = self.sorteddecs = None
+        self.tree = None
+
+    def build_index(self):
+        """Set up columns and indexes from rows"""
+        fpos = {f: n for n, f in enumerate(objdata.Objdata_fields)}
+        cols = list(zip(*self.rows)) if len(self.rows) != 0 else [()] * len(fpos)
+        self.inds = np.array(cols[fpos['ind']], dtype=np.int64)
+        self.names = np.array(cols[fpos['objname']], dtype=object)
+        self.vicinities = np.array(cols[fpos['vicinity']], dtype=object)
+        self.ras = np.array(cols[fpos['radeg']], dtype=np.float64)
+        self.decs = np.array(cols[fpos['decdeg']], dtype=np.float64)
+        self.variabilities = np.array(cols[fpos['variability']], dtype=np.float64)
+        self.usables = np.array(cols[fpos['usable']], dtype=bool)
+        self.decorder = np.argsort(self.decs, kind='stable')
+        self.sorteddecs = self.decs[self.decorder]
+        self.tree = cKDTree(unit_vectors(self.ras, self.decs)) if len(self.rows) != 0 else None
+
+    def load(self, dbcurs):
+        """Load all non-suppressed objects from database"""
+        self.counter = change_counter(dbcurs)
+        dbcurs.execute("SELECT " + objdata.objdata_select() + " FROM objdata WHERE suppress=0 ORDER BY ind")
+        self.rows = list(dbcurs.fetchall())
+        self.build_index()
+        return  self
+
+    def save(self, fname):
+        """Save snapshot to file, writing to temporary file first so readers never see partial file"""
+        dirname = os.path.dirname(os.path.abspath(fname))
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        except OSError as e:
+            raise ObjCatalogueErr("Could not save catalogue snapshot " + fname + " error was " + str(e))
+        try:
+            with os.fdopen(fd, 'wb') as outf:
+                pickle.dump((SNAPSHOT_VERSION, self.counter, self.rows), outf)
+            os.replace(tmpname, fname)
+        except OSError as e:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            raise ObjCatalogueErr("Could not save catalogue snapshot " + fname + " error was " + str(e))
+
+    def restore(self, fname):
+        """Restore snapshot from file returning whether successful"""
+        try:
+            with open(fname, 'rb') as inf:
+                version, counter, rows = pickle.load(inf)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return  False
+        if version != SNAPSHOT_VERSION:
+            return  False
+        self.counter = counter
+        self.rows = rows
+        self.build_index()
+        return  True
+
+    def cone(self, ra, dec, radius):
+        """Get array of indices into catalogue of objects within radius (degrees) of ra/dec"""
+        if self.tree is None:
+            return  np.array([], dtype=np.int64)
+        chord = 2.0 * np.sin(np.radians(min(radius, 180.0)) / 2.0)
+        return  np.array(sorted(self.tree.query_ball_point(unit_vectors([ra], [dec])[0], chord)), dtype=np.int64)
+
+    def box(self, minra, maxra, mindec, maxdec):
+        """Get array of indices into catalogue of objects within RA and DEC limits.
+        If minra is greater than maxra the box is taken to wrap around RA 0"""
+        lo = np.searchsorted(self.sorteddecs, mindec, side='left')
+        hi = np.searchsorted(self.sorteddecs, maxdec, side='right')
+        cands = self.decorder[lo:hi]
+        cras = self.ras[cands] % 360.0
+        minra %= 360.0
+        maxra %= 360.0
+        if minra <= maxra:
+            sel = (cras >= minra) & (cras <= maxra)
+        else:
+            sel = (cras >= minra) | (cras <= maxra)
+        return  np.sort(cands[sel])
+
+    def objects(self, indices):
+        """Get list of ObjData objects for indices into catalogue"""
+        return  [objdata.ObjData().load_row(self.rows[i]) for i in indices]
+
+    def get_sky_region(self, dbcurs, remfitsobj, maxvariability=0.0, usableonly=True, vicinity=None):
+        """Get objects in region of sky for frame as objdata.get_sky_region does.
+        The database is only used for the vicinity if it's an alias and proper motions
+        not already found in this process"""
+
+        if vicinity is None:
+            vicinity = remfitsobj.target
+            if not np.any(self.names == vicinity):
+                vicinity = objdata.get_objname(dbcurs, vicinity)
+        pixrows, pixcols = remfitsobj.data.shape
+        cornerpix = ((0, 0), (pixcols - 1, 0), (0, pixrows - 1), (pixcols - 1, pixrows - 1))
+        cornerradec = remfitsobj.wcs.pix_to_coords(cornerpix)
+        minra, maxra = ra_range(cornerradec[:,0])
+        found = self.box(minra, maxra, cornerradec[:,1].min(), cornerradec[:,1].max())
+        sel = (self.vicinities[found] == vicinity) & (self.variabilities[found] <= maxvariability)
+        if usableonly:
+            sel &= self.usables[found]
+        objlist = self.objects(found[sel])
+        objdata.apply_motion_many(dbcurs, objlist, remfitsobj.date)
+        return  sorted(objlist, key=lambda x: x.bri_sort(remfitsobj.filter))
+
+
+def load_catalogue(dbcurs, fname=None):
+    """Load catalogue from snapshot file if it's up to date with the database,
+    otherwise load from database and save snapshot"""
+    if fname is None:
+        fname = remdefaults.libfile(DEFAULT_SNAPSHOT, insist=True)
+    cat = ObjCatalogue()
+    if cat.restore(fname) and cat.counter == change_counter(dbcurs):
+        return  cat
+    cat.load(dbcurs)
+    try:
+        cat.save(fname)
+    except ObjCatalogueErr:
+        pass
+    return  cat
@@ -1,6 +1,10 @@
 """outines for object info database"""
 
 import datetime
+import time
+import re
+import contextlib
+import numpy as np
 import pymysql
 from astropy.time import Time
 from astropy.coordinates import SkyCoord
@@ -8,35 +12,101 @@ import astropy.units as u
 import objident
 import objposition
 import objparam
+import objmags
 import xmlutil
 import remfits
+import dbops
 
 # PM units
 
 MAS_YR = u.mas / u.yr
 
+# Distance to assume in light years when applying proper motion if we don't know it
+
+DEFAULT_PM_DIST = 1e8
+
+# Results of applying proper motion in this process indexed by (objind, date) giving (ra, dec, dist)
+
+MAX_MOTION_MEMO = 100000
+motion_memo = dict()
+
+# Cache of object names and aliases indexed by lower case name (as database is case-insensitive)
+# giving (object name, suppressed, is object name rather than alias)
+
+name_cache = None
+name_cache_time = 0.0
+name_cache_ttl = None
+
+# Fields in objdata table in order we load them for ObjData followed by magnitudes
+
+Objdata_fields = ("ind", "objname", "objtype", "dispname", "latexname", "vicinity", "label",
+                  "dist", "rv", "radeg", "decdeg", "rapm", "decpm",
+                  "apsize", "irapsize", "apstd", "irapstd", "basedon", "irbasedon", "variability", "invented", "usable",
+                  "suppress") + tuple(objmags.Database_fields)
+
+
+def objdata_select(table=None):
+    """Get list of fields for SELECT to load ObjData prefixing with table name if given"""
+    if table is None:
+        return  ",".join(Objdata_fields)
+    return  ",".join([table + "." + f for f in Objdata_fields])
+
+
 class  ObjDataError(Exception):
     """Class to report errors concerning individual objects"""
 
 
+def motion_dates(obstime):
+    """Get date and date/time for applying proper motion, taking noon on the day
+    as we remember the results by date"""
+    if isinstance(obstime, datetime.datetime):
+        obstime = obstime.date()
+    return  (obstime, datetime.datetime(obstime.year, obstime.month, obstime.day, 12, 0, 0))
+
+
+def set_name_cache_ttl(ttl):
+    """Set time in seconds after which we reload the name cache, None to keep it until changed"""
+    global name_cache_ttl
+    name_cache_ttl = ttl
+
+
+def invalidate_name_cache():
+    """Forget cached names after changing objects or aliases"""
+    global name_cache
+    name_cache = None
+
+
+def get_name_cache(dbcurs):
+    """Get cache of names and aliases, loading it all in one go if we haven't got it"""
+    global name_cache, name_cache_time
+    if name_cache is not None and (name_cache_ttl is None or time.monotonic() - name_cache_time < name_cache_ttl):
+        return  name_cache
+    dbcurs.execute("SELECT objname,objname,suppress,1 FROM objdata UNION ALL " \
+                   "SELECT alias,objdata.objname,suppress,0 FROM objalias INNER JOIN objdata ON objdata.objname=objalias.objname")
+    cache = dict()
+    for name, objname, supp, ismain in dbcurs.fetchall():
+        # Object names take priority over aliases
+        key = name.lower()
+        if ismain or key not in cache:
+            cache[key] = (objname, bool(supp), bool(ismain))
+    name_cache = cache
+    name_cache_time = time.monotonic()
+    return  cache
+
+
 def get_objname(dbcurs, alias, allobj=False):
     """Return unchanged name if if a main object name, otherwise find object name from alias ignoring suppressed objects unless allobj set"""
-    dbcurs.execute("SELECT objname,suppress FROM objdata WHERE objname=%s", alias)
-    f = dbcurs.fetchall()
-    if len(f) > 0:
-        name, supp = f[0]
+    try:
+        name, supp, ismain = get_name_cache(dbcurs)[alias.lower()]
+    except (KeyError, AttributeError):
+        raise ObjDataError("Unknown object or alias name", alias)
+    if ismain:
         if supp and not allobj:
             raise ObjDataError("Known but suppressed", alias)
         return alias
-    dbcurs.execute("SELECT objdata.objname,suppress FROM objalias INNER JOIN objdata WHERE objdata.objname=objalias.objname AND alias=%s", alias)
-    f = dbcurs.fetchall()
-    try:
-        name, supp = f[0]
-        if supp and not allobj:
-            raise ObjDataError("Aliased to " + name + " but is suppressed", alias)
-        return  name
-    except IndexError:
-        raise ObjDataError("Unknown object or alias name", alias)
+    if supp and not allobj:
+        raise ObjDataError("Aliased to " + name + " but is suppressed", alias)
+    return  name
 
 
 def nameused(dbcurs, name, allobj=False):
@@ -48,28 +118,72 @@ def nameused(dbcurs, name, allobj=False):
         return False
 
 
+def nextnames(dbcurs, prefix, count):
+    """Get list of count names to invent with given prefix, appending -001 etc
+    fetching all the existing names and aliases starting with the prefix in one go.
+    NB assuming exactly 3 digits. Do this and insert the objects inside name_lock
+    to avoid another process taking the same names (or use put_invented)"""
+    like = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    dbcurs.execute("SELECT objname,1 FROM objdata WHERE objname LIKE %s UNION ALL SELECT alias,0 FROM objalias WHERE alias LIKE %s", (like, like))
+    mtch = re.compile('^' + re.escape(prefix) + r'(?:-(\d\d\d))?$', re.IGNORECASE)
+    used = set()
+    hadobj = False
+    n = 0
+    for name, isobj in dbcurs.fetchall():
+        used.add(name.lower())
+        if isobj:
+            m = mtch.match(name)
+            if m is not None:
+                hadobj = True
+                if m.group(1) is not None:
+                    n = max(n, int(m.group(1)))
+    result = []
+    if not hadobj and prefix.lower() not in used and count > 0:
+        result.append(prefix)
+    while len(result) < count:
+        n += 1
+        newname = "{:s}-{:03d}".format(prefix, n)
+        if newname.lower() not in used:
+            result.append(newname)
+    return  result
+
+
 def nextname(dbcurs, prefix):
     """Get next name to invent with given prefix, appending -001 etc
     NB assuming exactly 3 digits"""
-    dbcurs.execute("SELECT objname FROM objdata WHERE objname REGEXP %s ORDER BY objname DESC LIMIT 1", '^' + prefix + '(-\d\d\d)?$')
-    exist = dbcurs.fetchall()
-    if len(exist) == 0:
-        if not nameused(dbcurs, prefix, True):
-            return  prefix
-        n = 0
-    else:
-        exist = exist[0][0]
-        ebits = exist.split('-')
-        lastc = ebits.pop()
-        if '-'.join(ebits) == prefix:
-            n = int(lastc)
-        else:
-            n = 0
-    while 1:
-        n += 1
-        newname = "{:s}-{:03d}".format(prefix, n)
-        if not nameused(dbcurs, newname, True):
-            return newname
+    return  nextnames(dbcurs, prefix, 1)[0]
+
+
+@contextlib.contextmanager
+def name_lock(dbcurs, prefix, timeout=30):
+    """Context manager holding database lock on inventing names with given prefix.
+    NB commits any open transaction once the lock is held so that reads inside see
+    names other processes committed whilst we were waiting"""
+    lockname = "objname:" + prefix
+    dbcurs.execute("SELECT GET_LOCK(%s,%s)", (lockname, timeout))
+    r = dbcurs.fetchone()
+    if r is None or r[0] != 1:
+        raise ObjDataError("Could not get lock to invent names", prefix)
+    try:
+        dbcurs.connection.commit()
+        yield
+    finally:
+        dbcurs.execute("SELECT RELEASE_LOCK(%s)", lockname)
+        dbcurs.fetchall()
+
+
+def put_invented(dbcurs, objlist, prefix):
+    """Give invented names with given prefix to list of objects and insert them,
+    committing before releasing the lock so no other process can take the same names"""
+    with name_lock(dbcurs, prefix):
+        try:
+            for obj, name in zip(objlist, nextnames(dbcurs, prefix, len(objlist))):
+                obj.set_invented(name)
+                obj.put(dbcurs)
+        except Exception:
+            dbcurs.connection.rollback()
+            raise
+        dbcurs.connection.commit()
 
 
 class ObjAlias:
@@ -123,6 +237,7 @@ class ObjAlias:
             fieldvalues.append("0")
         try:
             dbcurs.execute("INSERT INTO objalias (" + ",".join(fieldnames) + ") VALUES (" + ",".join(fieldvalues) + ")")
+            invalidate_name_cache()
         except pymysql.MySQLError as e:
             if e.args[0] == 1062:
                 raise ObjDataError("Duplicate alias " + self.aliasname + " object", self.objname)
@@ -146,6 +261,7 @@ class ObjAlias:
 
         try:
             dbcurs.execute("UPDATE objalias SET" + ",".join(fields) + " WHERE alias=" + conn.escape(self.aliasname))
+            invalidate_name_cache()
         except pymysql.MySQLError as e:
             raise ObjDataError("Could not update alias " + self.aliasname, e.args[1])
 
@@ -156,6 +272,7 @@ class ObjAlias:
         n = 0
         try:
             n = dbcurs.execute("DELETE FROM objalias WHERE alias=%s", self.aliasname)
+            invalidate_name_cache()
         except pymysql.MySQLError as e:
             raise ObjDataError("Could not delete alias " + self.aliasname, e.args[1])
         if n == 0:
@@ -191,21 +308,25 @@ class ObjData(objparam.ObjParam):
             selector = "objname=" + dbcurs.connection.escape(get_objname(dbcurs, self.objname, allobj=True))
             name = self.objname
 
-        dbcurs.execute("SELECT ind,objname,objtype,dispname,latexname,vicinity,label," \
-                       "dist,rv,radeg,decdeg,rapm,decpm," \
-                       "apsize,irapsize,apstd,irapstd,basedon,irbasedon,variability,invented,usable," \
-                       "suppress FROM objdata WHERE " + selector)
+        dbcurs.execute("SELECT " + objdata_select() + " FROM objdata WHERE " + selector)
         f = dbcurs.fetchall()
         if len(f) != 1:
             if len(f) == 0:
                 raise ObjDataError("(warning) Object not found", name)
             raise ObjDataError("Internal problem too many objects with name", name)
+        self.load_row(f[0])
+
+    def load_row(self, row):
+        """Set up from row of database fields in order of Objdata_fields"""
+        nmain = len(Objdata_fields) - len(objmags.Database_fields)
         self.objind, self.objname, self.objtype, self.dispname, self.latexname, self.vicinity, self.label, \
             self.dist, self.rv, self.ra, self.dec, self.rapm, self.decpm, \
             self.apsize, self.irapsize, self.apstd, self.irapstd, self.basedon, self.irbasedon, self.variability, \
-            self.invented, self.usable, self.suppress = f[0]
+            self.invented, self.usable, self.suppress = row[0:nmain]
+        for f, v in zip(objmags.Database_fields, row[nmain:]):
+            setattr(self, f, v)
         self.fix_dispname()
-        self.get_mags(dbcurs, self.objind)
+        return  self
 
     def put(self, dbcurs):
         """Save object to database"""
@@ -224,6 +345,7 @@ class ObjData(objparam.ObjParam):
         try:
             dbcurs.execute("INSERT INTO objdata (" + ",".join(fieldnames) + ") VALUES (" + ",".join(fieldvalues) + ")")
             self.objind = dbcurs.lastrowid
+            invalidate_name_cache()
         except pymysql.MySQLError as e:
             raise ObjDataError("Could not insert object " + self.objname, e.args[1])
 
@@ -243,6 +365,7 @@ class ObjData(objparam.ObjParam):
 
         try:
             dbcurs.execute("UPDATE objdata SET " + ",".join(fields) + " WHERE objname=%s", self.objname)
+            invalidate_name_cache()
         except pymysql.MySQLError as e:
             raise ObjDataError("Could not update object " + self.objname, e.args[1])
 
@@ -259,6 +382,7 @@ class ObjData(objparam.ObjParam):
         try:
             dbcurs.execute("DELETE FROM objalias WHERE objname=%s", name)
             n = dbcurs.execute("DELETE FROM objdata WHERE objname=%s", name)
+            invalidate_name_cache()
         except pymysql.MySQLError as e:
             raise ObjDataError("Could not delete object " + name, e.args[1])
         if n == 0:
@@ -302,6 +426,7 @@ class ObjData(objparam.ObjParam):
         except objident.ObjIdentErr as e:
             raise ObjDataError(e.getmessage())
         dbcurs.execute("DELETE FROM objalias WHERE objname=%s", self.objname)
+        invalidate_name_cache()
 
     def in_region_check(self, minra, maxra, mindec, maxdec):
         """Check if object is in region"""
@@ -313,41 +438,7 @@ class ObjData(objparam.ObjParam):
 
     def apply_motion(self, dbcurs, obstime):
         """Apply proper motion to object for given obs time"""
-
-        if self.rapm is None or self.decpm is None:
-            return
-
-        if isinstance(obstime, datetime.date):
-            obstime_date = obstime
-            obstime_datetime = datetime.datetime(obstime.year, obstime.month, obstime.day, 12, 0, 0)
-        else:
-            obstime_date = obstime.date()
-            obstime_datetime = obstime
-
-        if self.timebasedon == obstime_date:
-            return
-
-        dbcurs.execute("SELECT radeg,decdeg FROM objpm WHERE objind={:d} AND obsdate=%s".format(self.objind), "{:%Y-%m-%d}".format(obstime_date))
-        radec = dbcurs.fetchone()
-        if radec is not None:
-            self.ra, self.dec = radec
-            return
-
-        args = dict(ra=self.ra * u.deg, dec=self.dec * u.deg, obstime=Time('J2000'), pm_ra_cosdec=self.rapm * MAS_YR, pm_dec=self.decpm * MAS_YR)
-
-        if self.dist is not None:
-            args['distance'] = self.dist * u.lightyear
-
-        if self.rv is not None:
-            args['radial_velocity'] = self.rv * u.km / u.second
-
-        spos = SkyCoord(**args).apply_space_motion(new_obstime=Time(obstime_datetime))
-        self.ra = spos.ra.deg
-        self.dec = spos.dec.deg
-        if self.dist is not None:
-            self.dist = spos.distance.lightyear
-        self.timebasedon = obstime_date
-        dbcurs.execute("INSERT INTO objpm (objind,obsdate,radeg,decdeg) VALUES ({:d},%s,{:.9e},{:.9e})".format(self.objind, self.ra, self.dec), "{:%Y-%m-%d}".format(obstime_date))
+        apply_motion_many(dbcurs, [self], obstime)
 
     def apply_motion_check(self, dbcurs, obstime):
         """Apply proper motion (mostly) to coordinates"""
@@ -424,15 +515,75 @@ def get_sky_region(dbcurs, remfitsobj, maxvariability = 0.0, nosuppress = True,
     fieldselections.append(between_clause("radeg", cornerradec[:,0]))
     fieldselections.append(between_clause("decdeg", cornerradec[:,1]))
 
-    dbcurs.execute("SELECT ind FROM objdata WHERE " + " AND ".join(fieldselections), vicinity)
-    objrows = dbcurs.fetchall()
-
-    objlist = []
-    for objind, in objrows:
-        obj = ObjData()
-        obj.get(dbcurs, ind=objind)
-        obj.apply_motion(dbcurs, remfitsobj.date)
-        objlist.append(obj)
+    dbcurs.execute("SELECT " + objdata_select() + " FROM objdata WHERE " + " AND ".join(fieldselections), vicinity)
+    objlist = [ObjData().load_row(row) for row in dbcurs.fetchall()]
+    apply_motion_many(dbcurs, objlist, remfitsobj.date)
 
     # Sort into order of descending brightness
     return  sorted(objlist, key=lambda x: x.bri_sort(remfitsobj.filter))
+
+def clear_motion_memo():
+    """Forget remembered proper motion results"""
+    motion_memo.clear()
+
+def apply_motion_many(dbcurs, objlist, obstime):
+    """Apply proper motion to list of objects for given obs time.
+    Take results we've already had in this process, look up all the saved positions
+    in one go and calculate the rest together in one array"""
+
+    obstime_date, obstime_datetime = motion_dates(obstime)
+    todo = []
+    for o in objlist:
+        if o.rapm is None or o.decpm is None or o.timebasedon == obstime_date:
+            continue
+        try:
+            o.ra, o.dec, dist = motion_memo[(o.objind, obstime_date)]
+            if dist is not None:
+                o.dist = dist
+            o.timebasedon = obstime_date
+        except KeyError:
+            todo.append(o)
+    if len(todo) == 0:
+        return
+
+    if len(motion_memo) > MAX_MOTION_MEMO:
+        motion_memo.clear()
+
+    dbcurs.execute("SELECT objind,radeg,decdeg FROM objpm WHERE obsdate=%s AND objind IN (" + ",".join(["{:d}".format(o.objind) for o in todo]) + ")", "{:%Y-%m-%d}".format(obstime_date))
+    saved = {objind: (ra, dec) for objind, ra, dec in dbcurs.fetchall()}
+    misses = []
+    for o in todo:
+        try:
+            o.ra, o.dec = saved[o.objind]
+            motion_memo[(o.objind, obstime_date)] = (o.ra, o.dec, None)
+        except KeyError:
+            misses.append(o)
+    if len(misses) == 0:
+        return
+
+    # Fill in defaults for missing distance and radial velocity so we can do them all together,
+    # these give the same result as leaving them out
+
+    dists = np.array([o.dist for o in misses], dtype=np.float64)
+    rvs = np.array([o.rv for o in misses], dtype=np.float64)
+    dists[np.isnan(dists)] = DEFAULT_PM_DIST
+    rvs[np.isnan(rvs)] = 0.0
+    spos = SkyCoord(ra=np.array([o.ra for o in misses]) * u.deg, dec=np.array([o.dec for o in misses]) * u.deg, obstime=Time('J2000'),
+                    pm_ra_cosdec=np.array([o.rapm for o in misses]) * MAS_YR, pm_dec=np.array([o.decpm for o in misses]) * MAS_YR,
+                    distance=dists * u.lightyear, radial_velocity=rvs * u.km / u.second).apply_space_motion(new_obstime=Time(obstime_datetime))
+
+    ras = spos.ra.deg
+    decs = spos.dec.deg
+    newdists = spos.distance.lightyear
+    pmrows = []
+    for n, o in enumerate(misses):
+        o.ra = float(ras[n])
+        o.dec = float(decs[n])
+        dist = None
+        if o.dist is not None:
+            o.dist = dist = float(newdists[n])
+        o.timebasedon = obstime_date
+        motion_memo[(o.objind, obstime_date)] = (o.ra, o.dec, dist)
+        pmrows.append((o.objind, obstime_date, o.ra, o.dec))
+
+    dbops.insert_many(dbcurs, "objpm", ("objind", "obsdate", "radeg", "decdeg"), pmrows, update=("radeg", "decdeg"))
@@ -3,6 +3,11 @@
 # import sys
 import re
 import warnings
+import threading
+import queue
+import collections
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
 from astropy.time import Time
 from astropy.io import fits
 import numpy as np
@@ -27,6 +32,17 @@ ftypes = dict(F=('Daily flat', False), B=('Daily bias', False), I=('Image', True
 
 remir_types = frozenset(['H', 'J', 'K', 'GRI'])
 
+# Header keywords we keep in the header index so we can set up without fetching the FITS file
+# plus pattern for WCS keywords
+
+Index_keywords = frozenset(['OBJECT', 'DATE-OBS', 'DATE', '_ATE', 'CCDTEMP', 'TEMPCHIP', 'FILTER', 'FILENAME',
+                            'NAXIS1', 'NAXIS2', 'STARTX', 'STARTY', 'ENDX', 'ENDY'])
+wcskw = re.compile(r'(WCSAXES|CTYPE|CRVAL|CRPIX|CDELT|CUNIT|CROTA|CD\d_\d|PC\d_\d|PV\d_\d|EQUINOX|EPOCH|RADESYS|LONPOLE|LATPOLE|A_|B_|AP_|BP_)')
+
+# Default number of frames to fetch and decode ahead in iter_frames
+
+DEFAULT_PREFETCH = 4
+
 
 class RemFitsErr(Exception):
     """Throw this is something wrong"""
@@ -80,7 +96,7 @@ class Pixoffsets:
         except TypeError:
             self.rowoffset = rowoffset
             self.coloffset = coloffset
-        dbcurs.execute("UPDATE obsinf SET rowoffset={:.4f},coloffset={:.4f} WHERE obsind={:d}".format(self.rowoffset, self.coloffset, self.obsind))
+        dbcurs.execute("UPDATE obsinf SET rowoffset=%s,coloffset=%s WHERE obsind=%s", (float(self.rowoffset), float(self.coloffset), self.obsind))
 
 
 class RemFitsHdr:
@@ -105,6 +121,17 @@ class RemFitsHdr:
         if hdr is not None:
             self.init_from_header(hdr, nofn)
 
+    @classmethod
+    def from_index(cls, dbcurs, obsind, nofn=False):
+        """Set up from header index for obsind without fetching FITS file"""
+        dbcurs.execute("SELECT cards FROM fitshdr WHERE obsind={:d}".format(obsind))
+        rows = dbcurs.fetchall()
+        if len(rows) == 0:
+            raise RemFitsErr("No header index for obsind={:d}".format(obsind))
+        ret = cls(fits.Header.fromstring(rows[0][0]), nofn=nofn)
+        ret.from_obsind = obsind
+        return  ret
+
     def dims(self):
         """Quickly return dimensions as tuple"""
         return (self.startx, self.starty, self.endx, self.endy)
@@ -328,6 +355,290 @@ class RemFits(RemFitsHdr):
             raise RemFitsErr("Could not fetch iforbind=$d" % iforbind)
         self.init_from(hdr, data)
 
+def ensure_hdrindex(dbcurs):
+    """Make sure we have the header index table"""
+    dbcurs.execute("CREATE TABLE IF NOT EXISTS fitshdr (" \
+                   "obsind INT NOT NULL PRIMARY KEY, ind INT NOT NULL DEFAULT 0," \
+                   "date_obs DATETIME, filter VARCHAR(8), target VARCHAR(64), ftype VARCHAR(32), ccdtemp FLOAT," \
+                   "startx INT, starty INT, endx INT, endy INT, cards TEXT NOT NULL," \
+                   "KEY (ind), KEY (date_obs), KEY (filter), KEY (target))")
+
+
+def index_cards(hdr):
+    """Get cut-down header as string with just the keywords we need and the WCS"""
+    ihdr = fits.Header()
+    for card in hdr.cards:
+        if card.keyword.upper() in Index_keywords or wcskw.match(card.keyword):
+            ihdr.append(card)
+    return  ihdr.tostring()
+
+
+def index_header(dbcurs, hdr, obsind, ind=0, nofn=False):
+    """Add or replace header index entry for obsind from header"""
+    rh = RemFitsHdr(hdr, nofn)
+    dbcurs.execute("INSERT INTO fitshdr (obsind,ind,date_obs,filter,target,ftype,ccdtemp,startx,starty,endx,endy,cards) " \
+                   "VALUES ({:d},{:d},%s,%s,%s,%s,%s,{:d},{:d},{:d},{:d},%s) ".format(obsind, ind, rh.startx, rh.starty, rh.endx, rh.endy) + \
+                   "ON DUPLICATE KEY UPDATE ind=VALUES(ind),date_obs=VALUES(date_obs),filter=VALUES(filter),target=VALUES(target)," \
+                   "ftype=VALUES(ftype),ccdtemp=VALUES(ccdtemp),startx=VALUES(startx),starty=VALUES(starty)," \
+                   "endx=VALUES(endx),endy=VALUES(endy),cards=VALUES(cards)",
+                   (rh.date, rh.filter, rh.target, rh.ftype, rh.ccdtemp, index_cards(hdr)))
+    return  rh
+
+
+def index_obs(dbcurs, obsinds):
+    """Fill in header index for list of obsinds, fetching the FITS files.
+    Return list of (obsind, error message) for ones we couldn't do"""
+    ensure_hdrindex(dbcurs)
+    obsinds = list(obsinds)
+    if len(obsinds) == 0:
+        return  []
+    dbcurs.execute("SELECT obsind,ind FROM obsinf WHERE obsind IN (" + ",".join(["{:d}".format(o) for o in set(obsinds)]) + ")")
+    inds = dict(dbcurs.fetchall())
+    failures = []
+    for obsind, ffmem in remget.get_obs_fits_many(dbcurs, obsinds):
+        if isinstance(ffmem, remget.RemGetError):
+            failures.append((obsind, ffmem.args[0]))
+            continue
+        ff = fitsops.mem_open(ffmem)
+        if ff is None:
+            failures.append((obsind, "Could not decode FITS file"))
+            continue
+        hdr = ff[0].header
+        if len(ff) > 1 and isinstance(ff[1], fits.CompImageHDU):
+            hdr = ff[1].header
+        ff.close()
+        try:
+            index_header(dbcurs, hdr, obsind, inds.get(obsind, 0))
+        except RemFitsErr as e:
+            failures.append((obsind, e.args[0]))
+    dbcurs.connection.commit()
+    return  failures
+
+
+def decode_frame(obsind, ffmem):
+    """Decode fetched FITS file for obsind into RemFits object (without pixel offsets).
+    ffmem may be RemGetError exception if the fetch failed"""
+    if isinstance(ffmem, remget.RemGetError):
+        raise RemFitsErr(ffmem.args[0])
+    hdr, data = fitsops.mem_get(ffmem)
+    if hdr is None or data is None:
+        raise RemFitsErr("Could not fetch obsind=%d" % obsind)
+    return  RemFits(hdr, data, from_obsind=obsind)
+
+
+def iter_frames(dbcurs, ids, prefetch=DEFAULT_PREFETCH):
+    """Generator yielding (obsind, RemFits) for each of the obsinds in ids in order
+    of arrival, the RemFits object being a RemFitsErr exception if that one failed.
+    The next prefetch frames are fetched and decoded in background threads whilst
+    the caller works on the current one. All database access is done in the caller's
+    thread, so dbcurs may be used by the caller in between. Saved copies are read
+    from the database prefetch at a time"""
+
+    prefetch = max(1, prefetch)
+    errors, saved, fetch = remget.locate_obs(dbcurs, ids)
+    saved = collections.deque(saved)
+    fetched = remget.get_rest_many(fetch, prefetch)
+    pending = queue.Queue(maxsize=prefetch)
+    decoding = collections.deque()
+    stopping = threading.Event()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch)
+
+    def offer(item):
+        """Put item on queue, giving up if caller has gone away"""
+        while not stopping.is_set():
+            try:
+                pending.put(item, timeout=0.5)
+                return  True
+            except queue.Full:
+                pass
+        return  False
+
+    def producer():
+        """Fetch files from archive and queue up decoding"""
+        try:
+            for obsind, ffmem in fetched:
+                if not offer((obsind, pool.submit(decode_frame, obsind, ffmem))):
+                    return
+            offer(None)
+        except Exception as e:                  # pylint: disable=broad-except
+            offer((None, e))
+        finally:
+            fetched.close()
+
+    def result(obsind, fut):
+        """Get result of decoding adjusting offsets"""
+        try:
+            return  (obsind, fut.result().get_pixoffsets(dbcurs))
+        except RemFitsErr as e:
+            return  (obsind, e)
+
+    pthread = threading.Thread(target=producer, daemon=True)
+    pthread.start()
+    try:
+        for obsind, err in errors:
+            yield obsind, RemFitsErr(err.args[0])
+        fetching = True
+        while fetching or len(saved) != 0 or len(decoding) != 0:
+
+            # Read the next lot of saved copies when we've run out
+
+            if len(decoding) == 0 and len(saved) != 0:
+                chunk = [saved.popleft() for dummy in range(min(prefetch, len(saved)))]
+                for obsind, ffmem in remget.get_saved_many(dbcurs, chunk):
+                    decoding.append((obsind, pool.submit(decode_frame, obsind, ffmem)))
+
+            # Take from archive if one is ready or there's nothing else to do
+
+            item = False
+            if fetching:
+                try:
+                    item = pending.get(block=len(decoding) == 0)
+                except queue.Empty:
+                    pass
+            if item is None:
+                fetching = False
+            elif item is not False:
+                obsind, fut = item
+                if obsind is None:
+                    raise RemFitsErr("Error fetching frames - " + str(fut))
+                yield result(obsind, fut)
+            elif len(decoding) != 0:
+                yield result(*decoding.popleft())
+    finally:
+        stopping.set()
+        while True:
+            try:
+                pending.get_nowait()
+            except queue.Empty:
+                break
+        pthread.join()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class SharedFrame:
+    """Handle for RemFits object with data in shared memory block, small enough to send to other processes"""
+
+    def __init__(self, remfitsobj, blockname):
+        self.blockname = blockname
+        self.shape = remfitsobj.data.shape
+        self.dtype = remfitsobj.data.dtype.str
+        self.hdr = remfitsobj.hdr.tostring()
+        self.nofn = remfitsobj.ftype == "REMIR file"
+        self.from_obsind = remfitsobj.from_obsind
+        self.stats = (remfitsobj.meanval, remfitsobj.stdval, remfitsobj.skylev, remfitsobj.skystd, remfitsobj.skylevstd)
+        self.offsetpix = None
+        if remfitsobj.wcs is not None:
+            self.offsetpix = tuple(remfitsobj.wcs.offsetpix)
+        self.pixoff = None
+        if remfitsobj.pixoff is not None:
+            self.pixoff = (remfitsobj.pixoff.rowoffset, remfitsobj.pixoff.coloffset)
+
+    def attach(self):
+        """Get read-only RemFits object viewing data in the shared memory block.
+        Call detach on it when finished with"""
+        shm = attach_block(self.blockname)
+        ret = RemFits(fits.Header.fromstring(self.hdr), nofn=self.nofn, from_obsind=self.from_obsind)
+        data = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        data.flags.writeable = False
+        ret.data = data
+        ret.shm = shm
+        ret.meanval, ret.stdval, ret.skylev, ret.skystd, ret.skylevstd = self.stats
+        if self.offsetpix is not None:
+            ret.wcs.set_offsets(*self.offsetpix)
+        if self.pixoff is not None:
+            ret.pixoff = Pixoffsets(obsind=self.from_obsind)
+            ret.pixoff.rowoffset, ret.pixoff.coloffset = self.pixoff
+        return  ret
+
+
+attach_lock = threading.Lock()
+
+
+def attach_block(blockname):
+    """Attach existing shared memory block without this process taking charge of removing it"""
+    try:
+        return  shared_memory.SharedMemory(name=blockname, track=False)
+    except TypeError:
+        pass
+
+    # Before Python 3.13 attaching registers the block with the resource tracker
+    # which removes it when this process exits
+
+    with attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return  shared_memory.SharedMemory(name=blockname)
+        finally:
+            resource_tracker.register = register
+
+
+def detach(remfitsobj):
+    """Finish with RemFits object got from SharedFrame.attach"""
+    shm = getattr(remfitsobj, 'shm', None)
+    if shm is None:
+        return
+    remfitsobj.data = None
+    remfitsobj.shm = None
+    shm.close()
+
+
+class SharedFrames:
+    """Keep RemFits data in shared memory blocks for other processes,
+    removing each block when its reference count drops to zero"""
+
+    def __init__(self):
+        self.blocks = dict()
+        self.lock = threading.Lock()
+
+    def share(self, remfitsobj, refs=1):
+        """Copy data of RemFits object into new shared memory block with given number of references
+        and return SharedFrame handle to send to other processes"""
+        if remfitsobj.data is None:
+            raise RemFitsErr("No data to share")
+        shm = shared_memory.SharedMemory(create=True, size=max(1, remfitsobj.data.nbytes))
+        np.ndarray(remfitsobj.data.shape, dtype=remfitsobj.data.dtype, buffer=shm.buf)[...] = remfitsobj.data
+        with self.lock:
+            self.blocks[shm.name] = [shm, refs]
+        return  SharedFrame(remfitsobj, shm.name)
+
+    def addref(self, handle, refs=1):
+        """Add references to shared block"""
+        with self.lock:
+            try:
+                self.blocks[handle.blockname][1] += refs
+            except KeyError:
+                raise RemFitsErr("Shared frame " + handle.blockname + " already released")
+
+    def release(self, handle):
+        """Drop reference to shared block, removing it if it was the last one"""
+        with self.lock:
+            try:
+                ent = self.blocks[handle.blockname]
+            except KeyError:
+                raise RemFitsErr("Shared frame " + handle.blockname + " already released")
+            ent[1] -= 1
+            if ent[1] > 0:
+                return
+            del self.blocks[handle.blockname]
+        ent[0].close()
+        ent[0].unlink()
+
+    def close(self):
+        """Remove all the shared blocks regardless of references"""
+        with self.lock:
+            blocks = list(self.blocks.values())
+            self.blocks = dict()
+        for shm, dummy in blocks:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return  self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 # Parse argument file and return a suitable RemFits object
 
 
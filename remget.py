@@ -3,7 +3,16 @@
 """Routines for fetching FITS files"""
 
 import io
+import collections
+import os
+import os.path
+import fcntl
+import hashlib
+import tempfile
+import time
+import numpy as np
 import pycurl
+import fitsops
 
 
 class RemGetError(Exception):
@@ -12,10 +21,136 @@ class RemGetError(Exception):
 
 root_url = 'http://ross.iasfbo.inaf.it'
 
+# Local cache of files fetched from the archive, indexed by hash of the full name.
+# Setting cache_dir to None turns the cache off
+
+CACHE_SUFFIX = '.fits.gz'
+CACHE_LOCKFILE = 'cache.lock'
+DEFAULT_CACHE_MAXSIZE = 4 * 1024 ** 3
+
+
+def get_cachedir():
+    """Select cache directory for fetched FITS files or None if not caching"""
+    try:
+        return  os.environ["REMFITSCACHE"]
+    except KeyError:
+        return  None
+
+
+cache_dir = get_cachedir()
+cache_maxsize = DEFAULT_CACHE_MAXSIZE
+cache_stats = dict(hits=0, misses=0, evictions=0)
+
+
+def set_cache(dirname, maxsize=None):
+    """Set cache directory (None to turn off) and optionally the size cap in bytes"""
+    global cache_dir, cache_maxsize
+    cache_dir = dirname
+    if maxsize is not None:
+        cache_maxsize = maxsize
+
+
+def get_cache_stats():
+    """Return copy of hit/miss/eviction counts for cache"""
+    return  dict(cache_stats)
+
+
+def cache_fname(fullname):
+    """Get name of cache file for given full name"""
+    return  os.path.join(cache_dir, hashlib.sha1(fullname.encode()).hexdigest() + CACHE_SUFFIX)
+
+
+def cache_get(fullname):
+    """Get file from cache if we've got it, otherwise return None"""
+    if cache_dir is None:
+        return  None
+    fname = cache_fname(fullname)
+    try:
+        with open(fname, 'rb') as inf:
+            body = inf.read()
+    except OSError:
+        cache_stats['misses'] += 1
+        return  None
+    cache_stats['hits'] += 1
+    # Touch file so eviction takes least recently used first
+    try:
+        os.utime(fname)
+    except OSError:
+        pass
+    return  body
+
+
+def cache_evict():
+    """Remove least recently used files from cache until we are within the size limit.
+    Lock out other processes trying to do the same thing whilst we're doing it"""
+    try:
+        with open(os.path.join(cache_dir, CACHE_LOCKFILE), 'a') as lockf:
+            fcntl.lockf(lockf, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for de in os.scandir(cache_dir):
+                if not de.name.endswith(CACHE_SUFFIX):
+                    continue
+                try:
+                    st = de.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, de.path))
+                total += st.st_size
+            if total <= cache_maxsize:
+                return
+            entries.sort()
+            for dummy, size, path in entries:
+                if total <= cache_maxsize:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                cache_stats['evictions'] += 1
+    except OSError:
+        pass
+
+
+def cache_put(fullname, body):
+    """Save file in cache, writing to temporary file and renaming so other processes
+    never see a partial file. Failures just mean we don't cache"""
+    if cache_dir is None:
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as outf:
+            outf.write(body)
+        os.replace(tmpname, cache_fname(fullname))
+    except OSError:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        return
+    cache_evict()
+
+
+def check_body(fullname, rcode, body):
+    """Check what we got back from the archive looks like a FITS file"""
+    if rcode != 200:
+        raise RemGetError("Error %s fetching FITS file" % rcode)
+    if len(body) < 10000 or body[0:6] == b'<html>':
+        raise RemGetError("FITS file not found " + fullname)
+
 
 def get_rest(fullname):
     """Do the result of the job after constructinve the full name"""
 
+    body = cache_get(fullname)
+    if body is not None:
+        return  body
+
     buffer = io.BytesIO()
     c = pycurl.Curl()
     c.setopt(c.URL, root_url + fullname)
@@ -23,24 +158,106 @@ def get_rest(fullname):
     c.setopt(c.WRITEDATA, buffer)
     c.perform()
     rcode = c.getinfo(c.RESPONSE_CODE)
-    if rcode != 200:
-        raise RemGetError("Error %s fetching FITS file" % rcode)
     c.close()
     body = buffer.getvalue()
-    if len(body) < 10000 or body[0:6] == b'<html>':
-        raise RemGetError("FITS file not found " + fullname)
+    check_body(fullname, rcode, body)
+    cache_put(fullname, body)
     return body
 
 
-def get_obs(fname, remir=False):
-    """Get observation file as byte string"""
+def get_rest_many(jobs, max_parallel=8, ready=()):
+    """Generator to fetch several files concurrently.
+    jobs is a list of (key, fullname), yields (key, body) as each one completes,
+    with body a RemGetError exception in place of the data if that one failed.
+    ready is a list of (key, body) we've already got, handed out between transfers"""
+
+    ready = collections.deque(ready)
+    queue = collections.deque()
+    for key, fullname in jobs:
+        body = cache_get(fullname)
+        if body is None:
+            queue.append((key, fullname))
+        else:
+            ready.append((key, body))
+
+    multi = pycurl.CurlMulti()
+    free = [pycurl.Curl() for dummy in range(max(1, min(max_parallel, len(queue))))]
+    busy = []
+
+    try:
+        while len(queue) != 0 or len(busy) != 0:
+            while len(queue) != 0 and len(free) != 0:
+                key, fullname = queue.popleft()
+                c = free.pop()
+                c.remjob = (key, fullname, io.BytesIO())
+                c.setopt(c.URL, root_url + fullname)
+                c.setopt(c.FOLLOWLOCATION, 1)
+                c.setopt(c.WRITEDATA, c.remjob[2])
+                multi.add_handle(c)
+                busy.append(c)
+
+            while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                pass
+
+            done = []
+            while True:
+                nqueued, oklist, errlist = multi.info_read()
+                for c in oklist:
+                    key, fullname, buffer = c.remjob
+                    body = buffer.getvalue()
+                    try:
+                        check_body(fullname, c.getinfo(c.RESPONSE_CODE), body)
+                        cache_put(fullname, body)
+                    except RemGetError as e:
+                        body = e
+                    done.append((c, key, body))
+                for c, dummy, errmsg in errlist:
+                    key, fullname, buffer = c.remjob
+                    done.append((c, key, RemGetError("Error " + errmsg + " fetching FITS file " + fullname)))
+                if nqueued == 0:
+                    break
+
+            for c, key, body in done:
+                multi.remove_handle(c)
+                busy.remove(c)
+                c.remjob = None
+                free.append(c)
+                yield key, body
+
+            # Hand out one of the ones we've already got whilst waiting
+
+            if len(ready) != 0:
+                yield ready.popleft()
+            elif len(done) == 0 and len(busy) != 0:
+                multi.select(1.0)
+
+        while len(ready) != 0:
+            yield ready.popleft()
+
+    finally:
+        for c in busy:
+            multi.remove_handle(c)
+            c.close()
+        for c in free:
+            c.close()
+        multi.close()
+
+
+def obs_path(fname, remir=False):
+    """Get path of observation file in archive"""
 
     if remir:
         fullfname = "Remir/" + fname
     else:
         fullfname = "Ross/" + fname
 
-    return  get_rest("/RossDB/fits_retrieve.php?ffile=/" + fullfname)
+    return  "/RossDB/fits_retrieve.php?ffile=/" + fullfname
+
+
+def get_obs(fname, remir=False):
+    """Get observation file as byte string"""
+
+    return  get_rest(obs_path(fname, remir))
 
 
 def get_iforb(fname):
@@ -50,7 +267,8 @@ def get_iforb(fname):
 
 
 def get_saved_fits(dbcurs, ind):
-    """Get FITS file when we've saved a copy"""
+    """Get FITS file when we've saved a copy.
+    This may be in either whole file gzip or tiled format, fitsops.mem_get decodes either"""
     if ind == 0:
         raise RemGetError("Attempting load FITS with zero ind")
     dbcurs.execute("SELECT fitsgz FROM fitsfile WHERE ind=%d" % ind)
@@ -72,6 +290,69 @@ def get_obs_fits(dbcurs, obsind):
     return  get_obs(ffname, dith != 0)
 
 
+def locate_obs(dbcurs, obsinds):
+    """Find where several obs files are without fetching any.
+    Return tuple of list of (obsind, RemGetError) for those we couldn't find,
+    list of (obsind, ind) for those we have saved copies of and list of (obsind, fullname)
+    to fetch from archive"""
+
+    obsinds = list(obsinds)
+    if len(obsinds) == 0:
+        return  ([], [], [])
+    dbcurs.execute("SELECT obsind,dithID,ind,ffname FROM obsinf WHERE obsind IN (" + ",".join(["{:d}".format(o) for o in set(obsinds)]) + ")")
+    locs = {obsind: (dith, ind, ffname) for obsind, dith, ind, ffname in dbcurs.fetchall()}
+
+    errors = []
+    saved = []
+    fetch = []
+    for obsind in obsinds:
+        try:
+            dith, ind, ffname = locs[obsind]
+        except KeyError:
+            errors.append((obsind, RemGetError("Unable to locate obs ind %d" % obsind)))
+            continue
+        if ind != 0:
+            saved.append((obsind, ind))
+        else:
+            fetch.append((obsind, obs_path(ffname, dith != 0)))
+    return  (errors, saved, fetch)
+
+
+def get_saved_many(dbcurs, saved):
+    """Get saved FITS files for list of (obsind, ind) as from locate_obs in one query.
+    Return list of (obsind, body) with body RemGetError if we couldn't find it"""
+
+    if len(saved) == 0:
+        return  []
+    dbcurs.execute("SELECT ind,fitsgz FROM fitsfile WHERE ind IN (" + ",".join(["{:d}".format(i) for i in {ind for dummy, ind in saved}]) + ")")
+    bodies = dict(dbcurs.fetchall())
+    result = []
+    for obsind, ind in saved:
+        try:
+            result.append((obsind, bodies[ind]))
+        except KeyError:
+            result.append((obsind, RemGetError("Cannot find fits file id %d" % ind)))
+    return  result
+
+
+def locate_obs_fits(dbcurs, obsinds):
+    """Do all the database work for fetching several obs files.
+    Return tuple of list of (obsind, body) for those we have saved copies of (body being
+    RemGetError if we couldn't find it) and list of (obsind, fullname) to fetch from archive"""
+
+    errors, saved, fetch = locate_obs(dbcurs, obsinds)
+    return  (errors + get_saved_many(dbcurs, saved), fetch)
+
+
+def get_obs_fits_many(dbcurs, obsinds, max_parallel=8):
+    """Return generator to get FITS files for several obsinds from our copy or remote,
+    fetching remote ones concurrently. Yields (obsind, body) in order of completion
+    with body a RemGetError exception in place of the data if that one failed"""
+
+    ready, fetch = locate_obs_fits(dbcurs, obsinds)
+    return  get_rest_many(fetch, max_parallel, ready)
+
+
 def get_iforb_fits(dbcurs, iforbind):
     """Get FITS file for bias or flat from either our copy or remote"""
     dbcurs.execute("SELECT ind,ffname FROM iforbinf WHERE iforbind=%d" % iforbind)
@@ -96,3 +377,48 @@ def delete_fits(dbcurs, ind):
     dbcurs.execute("UPDATE obsinf SET ind=0 WHERE ind=%d" % ind)
     dbcurs.execute("UPDATE iforbinf SET ind=0 WHERE ind=%d" % ind)
     dbcurs.connection.commit()
+
+
+def ensure_fitsfmt(dbcurs):
+    """Make sure we have the column giving format of saved FITS files"""
+    if dbcurs.execute("SHOW COLUMNS FROM fitsfile LIKE 'fitsfmt'") == 0:
+        dbcurs.execute("ALTER TABLE fitsfile ADD COLUMN fitsfmt ENUM(%s,%s) NOT NULL DEFAULT %s", (fitsops.FITS_GZIP, fitsops.FITS_TILED, fitsops.FITS_GZIP))
+        dbcurs.connection.commit()
+
+
+def reencode_saved_fits(dbcurs, fmt=fitsops.FITS_TILED, batchsize=50, limit=None):
+    """Re-encode saved FITS files into the given format in batches, checking the data
+    comes back the same before replacing each one.
+    Return dictionary giving number done and failed, total sizes and decode times before and after"""
+
+    ensure_fitsfmt(dbcurs)
+    report = dict(done=0, failed=0, oldsize=0, newsize=0, oldtime=0.0, newtime=0.0)
+    lastind = 0
+    while limit is None or report['done'] + report['failed'] < limit:
+        dbcurs.execute("SELECT ind,fitsgz FROM fitsfile WHERE fitsfmt!=%s AND ind>{:d} ORDER BY ind LIMIT {:d}".format(lastind, batchsize), fmt)
+        rows = dbcurs.fetchall()
+        if len(rows) == 0:
+            break
+        for ind, oldbytes in rows:
+            lastind = ind
+            st = time.perf_counter()
+            hdr, data = fitsops.mem_get(oldbytes)
+            oldtime = time.perf_counter() - st
+            if data is None:
+                report['failed'] += 1
+                continue
+            newbytes = fitsops.mem_makesaved(hdr, data, fmt)
+            st = time.perf_counter()
+            dummy, newdata = fitsops.mem_get(newbytes)
+            newtime = time.perf_counter() - st
+            if newdata is None or not np.array_equal(data, newdata):
+                report['failed'] += 1
+                continue
+            dbcurs.execute("UPDATE fitsfile SET fitsgz=%s,fitsfmt=%s WHERE ind={:d}".format(ind), (newbytes, fmt))
+            report['done'] += 1
+            report['oldsize'] += len(oldbytes)
+            report['newsize'] += len(newbytes)
+            report['oldtime'] += oldtime
+            report['newtime'] += newtime
+        dbcurs.connection.commit()
+    return  report
@@ -65,6 +65,7 @@ class SearchParam:
         self.signif = DEFAULT_SIGN
         self.totsig = DEFAULT_TOTSIGN
         self.maxshift = DEFAULT_MAXSHIFT
+        self.maxshift2 = DEFAULT_SHIFT2
         self.lookaround = DEFAULT_LOOKAROUND
         self.defapsize = DEFAULT_DEFAPSIZE
         self.singlepixn = DEFAULT_SINGLEPIX
@@ -75,6 +76,7 @@ class SearchParam:
         self.offsetsig = DEFAULT_OFFSETSIG
         self.ampsig = DEFAULT_AMPSIG
         self.sigmasig = DEFAULT_SIGMASIG
+        self.minsingpix = DEFAULT_MINSINGLEPIX
         self.saveparams = False
 
     def load(self, node):
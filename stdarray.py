@@ -265,14 +265,11 @@ class StdArray:
     def get_sum(self, col, row, apsize):
         """Get sum of values and error around row and column with given aperture size
         row, col and apsize may all be fractional"""
-        xycoords = apoffsets.ap_offsets(col, row, apsize) + (int(col), int(row))
-        vs = self.get_values()
-        errs = self.stdsq
         try:
-            return  (np.sum([vs[(y,x)] for x,y in xycoords]), math.sqrt(np.sum([errs[(y,x)] for x, y in xycoords])))
-        except IndexError:
-            # print("col={:.4f} row={:.4f} apsize={:.4f}".format(col,row,apsize), xycoords)
+            dummy, (vs, errs) = apoffsets.ap_gather(col, row, apsize, (self.get_values(), self.stdsq))
+        except apoffsets.ApOffsetsErr:
             raise StdArrayErr(INCOMPAT_SHAPE, "Coords out of range")
+        return  (np.sum(vs), math.sqrt(np.sum(errs)))
 
     def __add__(self, other):
         try: